@@ -13,7 +13,8 @@ class Harvester(CkanCommand):
     Usage:
 
       harvester initdb
-        - Creates the necessary tables in the database
+        - Creates the necessary tables in the database, or upgrades existing
+          ones to the latest schema version
 
       harvester source {url} {type} [{active}] [{user-id}] [{publisher-id}]
         - create new harvest source
@@ -28,8 +29,10 @@ class Harvester(CkanCommand):
       harvester job {source-id}
         - create new harvest job
 
-      harvester jobs
-        - lists harvest jobs
+      harvester [--limit={n}] [--after={job-id}] jobs
+        - lists harvest jobs, with their number of objects and gather errors.
+          If --limit is provided, only that number of jobs is shown, and the
+          command to show the next ones is printed.
 
       harvester run
         - runs harvest jobs
@@ -79,6 +82,12 @@ class Harvester(CkanCommand):
 '''A string containing hex digits that represent which of
  the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f''')
 
+        self.parser.add_option('--limit', dest='limit', type='int',
+            default=None, help='Number of harvest jobs to list')
+
+        self.parser.add_option('--after', dest='after',
+            default=None, help='Id of the last harvest job of the previous page')
+
     def command(self):
         self._load_config()
 
@@ -115,9 +124,9 @@ class Harvester(CkanCommand):
         elif cmd == 'fetch_consumer':
             import logging
             logging.getLogger('amqplib').setLevel(logging.INFO)
-            from ckanext.harvest.queue import get_fetch_consumer
+            from ckanext.harvest.queue import get_fetch_consumer, consume
             consumer = get_fetch_consumer()
-            consumer.wait()
+            consume(consumer)
         elif cmd == 'initdb':
             self.initdb()
         elif cmd == 'import':
@@ -136,7 +145,7 @@ class Harvester(CkanCommand):
 
     def initdb(self):
         from ckanext.harvest.model import setup as db_setup
-        db_setup()
+        db_setup(upgrade=True)
 
         print 'DB tables created'
 
@@ -228,15 +237,34 @@ class Harvester(CkanCommand):
         job = get_action('harvest_job_create')(context,{'source_id':source_id})
 
         self.print_harvest_job(job)
+        context['summary'] = True
         jobs = get_action('harvest_job_list')(context,{'status':u'New'})
         self.print_there_are('harvest jobs', jobs, condition=u'New')
 
     def list_harvest_jobs(self):
-        context = {'model': model, 'user': self.admin_user['name'], 'session':model.Session}
-        jobs = get_action('harvest_job_list')(context,{})
+        # Only the number of objects is shown, so don't dictize them
+        context = {'model': model, 'user': self.admin_user['name'], 'session':model.Session,
+                   'summary': True}
+        data_dict = {}
+        if self.options.limit:
+            data_dict['limit'] = self.options.limit
+            if self.options.after:
+                data_dict['after'] = self.options.after
+        try:
+            jobs = get_action('harvest_job_list')(context,data_dict)
+        except ValidationError, e:
+            print 'An error occurred:'
+            print str(e.error_dict)
+            sys.exit(1)
 
-        self.print_harvest_jobs(jobs)
-        self.print_there_are(what='harvest job', sequence=jobs)
+        if self.options.limit:
+            self.print_harvest_jobs(jobs['results'])
+            if jobs['next']:
+                print 'More jobs: harvester --limit=%i --after=%s jobs' % \
+                      (self.options.limit, jobs['next'])
+        else:
+            self.print_harvest_jobs(jobs)
+            self.print_there_are(what='harvest job', sequence=jobs)
 
     def run_harvester(self):
         context = {'model': model, 'user': self.admin_user['name'], 'session':model.Session}
@@ -291,7 +319,11 @@ class Harvester(CkanCommand):
         print '       Job id: %s' % job['id']
         print '       status: %s' % job['status']
         print '       source: %s' % job['source']
-        print '      objects: %s' % len(job['objects'])
+        if 'object_count' in job:
+            print '      objects: %s (%s fetched, %s imported)' % \
+                  (job['object_count'], job['fetched_count'], job['imported_count'])
+        else:
+            print '      objects: %s' % len(job['objects'])
 
         print 'gather_errors: %s' % len(job['gather_errors'])
         if (len(job['gather_errors']) > 0):
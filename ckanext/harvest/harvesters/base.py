@@ -1,28 +1,240 @@
 import logging
 import re
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
 
 from sqlalchemy.sql import update,and_, bindparam
+from pylons import config as ckan_config
+from paste.deploy.converters import asbool
 
 from ckan import model
 from ckan.model import Session, Package
-from ckan.logic import ValidationError, NotFound, get_action
+from ckan.model.types import make_uuid
+from ckan.lib.helpers import json
+from ckan.logic import ValidationError, get_action
 
 from ckan.logic.schema import default_package_schema
 from ckan.lib.navl.validators import ignore_missing,ignore
+from ckan.lib.navl.dictization_functions import validate
+from ckan.lib.dictization.model_save import package_api_to_dict, package_dict_save
 from ckan.lib.munge import munge_title_to_name,substitute_ascii_equivalents
 
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+from ckanext.harvest.model import HarvestJob, HarvestObject, update_current_flags, \
+                                    save_errors, update_watermarks, unit_of_work
 
 from ckan.plugins.core import SingletonPlugin, implements
+from ckan.plugins import PluginImplementations, IPackageController
 from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.indexing import IndexQueue, get_search_index, \
+                                     synchronous_indexing_suspended
 
 log = logging.getLogger(__name__)
 
-def munge_tag(tag):
+_tag_invalid_chars = re.compile(r'[^a-zA-Z0-9 -]')
+
+def _munge_tag(tag):
     tag = substitute_ascii_equivalents(tag)
     tag = tag.lower().strip()
-    return re.sub(r'[^a-zA-Z0-9 -]', '', tag).replace(' ', '-')
+    return _tag_invalid_chars.sub('', tag).replace(' ', '-')
+
+class TagMunger(object):
+    '''
+    Normalises tags, keeping the last max_size results in a LRU cache, as
+    sources tend to use the same tags over and over.
+    '''
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, tag):
+        try:
+            munged = self.cache.pop(tag)
+            self.hits += 1
+        except KeyError:
+            munged = _munge_tag(tag)
+            self.misses += 1
+            if len(self.cache) >= self.max_size:
+                self.cache.popitem(last=False)
+        # Move it to the end, as the most recently used
+        self.cache[tag] = munged
+        return munged
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+tag_munger = TagMunger()
+
+def munge_tag(tag):
+    return tag_munger(tag)
+
+def unique(items):
+    '''
+    Yields the items in the same order, skipping the ones already seen
+    '''
+    seen = set()
+    for item in items:
+        if not item in seen:
+            seen.add(item)
+            yield item
+
+# Parts of the error messages that usually change between objects
+_fingerprint_substitutions = [
+    (re.compile(r'\w+://\S+'), '<url>'),
+    (re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.I), '<id>'),
+    (re.compile(r'\d+'), '<n>'),
+]
+
+def error_fingerprint(message):
+    '''
+    Returns a hash that identifies similar error messages
+    '''
+    if isinstance(message, unicode):
+        message = message.encode('utf8')
+    for pattern, replacement in _fingerprint_substitutions:
+        message = pattern.sub(replacement, message)
+    return unicode(hashlib.md5(message).hexdigest())
+
+class ErrorBuffer(object):
+    '''
+    Collects the errors found while harvesting so they can be written in
+    bulk. Errors with the same fingerprint on the same job and stage are
+    only stored individually the first few times (max_samples), but all of
+    them are counted in the error summary.
+    '''
+
+    def __init__(self, max_samples=10):
+        self.max_samples = max_samples
+        self.gather_errors = []
+        self.object_errors = []
+        self.summaries = {}
+        # Samples written so far for each (job, stage, fingerprint)
+        self.samples = {}
+
+    def __len__(self):
+        return len(self.gather_errors) + len(self.object_errors) + len(self.summaries)
+
+    def add(self, message, job_id, stage, object_id=None):
+        fingerprint = error_fingerprint(message)
+        now = datetime.datetime.utcnow()
+        key = (job_id, stage, fingerprint)
+
+        summary = self.summaries.get(key)
+        if not summary:
+            summary = self.summaries[key] = {
+                'id': make_uuid(),
+                'harvest_job_id': job_id,
+                'stage': stage,
+                'fingerprint': fingerprint,
+                'message': message,
+                'count': 0,
+                'first_seen': now,
+                'sample_object_ids': [],
+            }
+        summary['count'] += 1
+        summary['last_seen'] = now
+
+        samples = self.samples.get(key, 0)
+        if samples >= self.max_samples:
+            return
+        self.samples[key] = samples + 1
+
+        error = {
+            'id': make_uuid(),
+            'message': message,
+            'fingerprint': fingerprint,
+            'created': now,
+        }
+        if object_id:
+            error.update({'harvest_object_id': object_id, 'stage': stage})
+            self.object_errors.append(error)
+            summary['sample_object_ids'].append(object_id)
+        else:
+            error['harvest_job_id'] = job_id
+            self.gather_errors.append(error)
+
+    def flush(self):
+        if not len(self):
+            return
+
+        summaries = []
+        for summary in self.summaries.values():
+            summary = dict(summary)
+            summary['sample_object_ids'] = u' '.join(summary['sample_object_ids'])
+            summaries.append(summary)
+
+        save_errors(self.gather_errors, self.object_errors, summaries)
+
+        self.gather_errors = []
+        self.object_errors = []
+        self.summaries = {}
+        # Don't let the sample counts grow forever on long running workers
+        if len(self.samples) > 10000:
+            self.samples = {}
+
+class FrozenDict(dict):
+    '''
+    Dictionary that can't be modified
+    '''
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s objects are read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((k, _freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+class SourceConfig(FrozenDict):
+    '''
+    The parsed configuration of a harvest source. It can't be modified, so
+    the same object can be shared by all the stages and threads working on
+    the source. Use get_source_config() to get it.
+    '''
+
+    def __init__(self, source_id, config_str):
+        values = json.loads(config_str) if config_str else {}
+        dict.__init__(self, ((k, _freeze(v)) for k, v in values.iteritems()))
+        self.source_id = source_id
+
+# Parsed source configs, keyed by (source id, hash of the config string)
+_source_configs = {}
+_source_configs_lock = threading.Lock()
+
+def get_source_config(source_id, config_str):
+    '''
+    Returns the SourceConfig for the source, parsing the config string only
+    the first time it is seen.
+    '''
+    config_str = config_str or ''
+    if isinstance(config_str, unicode):
+        config_str = config_str.encode('utf8')
+    config_hash = hashlib.md5(config_str).hexdigest()
+    key = (source_id, config_hash)
+    config = _source_configs.get(key)
+    if config is None:
+        config = SourceConfig(source_id, config_str)
+        log.debug('Using config for source %s: %r', source_id, config)
+        with _source_configs_lock:
+            if len(_source_configs) >= 100:
+                _source_configs.clear()
+            _source_configs[key] = config
+    return config
+
 
 class HarvesterBase(SingletonPlugin):
     '''
@@ -32,6 +244,103 @@ class HarvesterBase(SingletonPlugin):
 
     config = None
 
+    # Modification date, state and name of the packages imported by a job
+    # (see _get_package_state)
+    _package_states = None
+
+    # Package ids to the harvest object that last imported them, waiting
+    # for their current flags to be updated
+    _pending_current = None
+
+    _error_buffer = None
+
+    # Packages waiting to be indexed when ckan.harvest.defer_indexing is on
+    _index_queue = None
+
+    # Ids of the packages written by each harvest object inside the current
+    # unit of work (see discard_object)
+    _written_packages = None
+
+    def flush_batch(self):
+        '''
+        Writes the work deferred while processing the last batch of objects.
+        This is called by the fetch consumer when the queue is empty and
+        after committing a unit of work, after the gather stage and at the
+        end of harvest_objects_import.
+        '''
+        if self._bulk_packages:
+            self.write_packages()
+        # The packages of the batch exist now, so their names will be found
+        self._reserved_names = {}
+
+        if self._error_buffer:
+            self._error_buffer.flush()
+
+        if self._pending_watermarks:
+            update_watermarks(self._pending_watermarks)
+        self._pending_watermarks = {}
+
+        if self._pending_current:
+            update_current_flags(self._pending_current)
+            log.debug('Updated current flags for %i packages', len(self._pending_current))
+        self._pending_current = {}
+        self._written_packages = {}
+
+        # Don't index packages that have not been committed yet
+        if self._index_queue and not unit_of_work.active:
+            self._index_queue.flush()
+
+        if tag_munger.hits or tag_munger.misses:
+            log.debug('Tag cache: %i hits, %i misses (%.1f%% hit rate)',
+                      tag_munger.hits, tag_munger.misses, tag_munger.hit_rate() * 100)
+
+    def discard_object(self, harvest_object):
+        '''
+        Drops the work deferred for a harvest object whose changes have been
+        rolled back by the worker (see queue.fetch_callback), so flush_batch
+        doesn't act on a package that no longer exists. Returns the id of
+        the package the object had written, if any.
+        '''
+        object_id = harvest_object.id
+        if self._bulk_packages:
+            self._bulk_packages = [item for item in self._bulk_packages
+                                   if item[1].id != object_id]
+
+        package_id = (self._written_packages or {}).pop(object_id, None)
+        if package_id is None:
+            return None
+
+        if self._pending_current and self._pending_current.get(package_id) == object_id:
+            del self._pending_current[package_id]
+        # Look up the package again, it may not exist anymore
+        if self._package_states:
+            self._package_states[1].pop(package_id, None)
+            self._package_states[2].discard(package_id)
+        # Unless another object of the batch has written it too
+        if self._index_queue and not package_id in self._written_packages.values():
+            self._index_queue.discard(package_id)
+        return package_id
+
+    def _get_index_queue(self):
+        if self._index_queue is None:
+            index = get_search_index(ckan_config.get('ckan.harvest.search_index', 'solr'))
+            self._index_queue = IndexQueue(index, self._get_batch_size())
+        return self._index_queue
+
+    def _suspend_synchronous_indexing(self):
+        '''
+        Returns a context manager that stops CKAN from indexing the packages
+        written inside it when they are queued for deferred indexing
+        '''
+        return synchronous_indexing_suspended(
+            asbool(ckan_config.get('ckan.harvest.defer_indexing', False)))
+
+    def _get_batch_size(self):
+        try:
+            return int(ckan_config.get('ckan.harvest.batch_size', 100))
+        except ValueError:
+            return 100
+
     def _gen_new_name(self,title):
         '''
         Creates a URL friendly name from a title
@@ -41,38 +350,130 @@ class HarvesterBase(SingletonPlugin):
             name = name.replace('--', '-')
         return name
 
-    def _check_name(self,name):
+    def _check_name(self,name,job_id=None):
         '''
         Checks if a package name already exists in the database, and adds
         a counter at the end if it does exist.
+
+        Names are looked up by exact match in batches of candidates (using
+        the unique index on the package name). The names returned for a job
+        are reserved until the next flush_batch, so objects of the same job
+        imported in the same batch don't get the same name before their
+        packages are written.
         '''
-        like_q = u'%s%%' % name
-        pkg_query = Session.query(Package).filter(Package.name.ilike(like_q)).limit(100)
-        taken = [pkg.name for pkg in pkg_query]
-        if name not in taken:
-            return name
-        else:
-            counter = 1
-            while counter < 101:
-                if name+str(counter) not in taken:
-                    return name+str(counter)
+        reserved = self._get_reserved_names(job_id)
+
+        counter = 0
+        while True:
+            candidates = []
+            while len(candidates) < 100:
+                candidate = name + str(counter) if counter else name
+                if not candidate in reserved:
+                    candidates.append(candidate)
                 counter = counter + 1
-            return None
+
+            taken = set([row[0] for row in Session.query(Package.name) \
+                                            .filter(Package.name.in_(candidates))])
+            for candidate in candidates:
+                if not candidate in taken:
+                    reserved.add(candidate)
+                    return candidate
+
+    # Names given to packages for each job since the last flush_batch (see
+    # _check_name)
+    _reserved_names = None
+
+    def _get_reserved_names(self, job_id):
+        if self._reserved_names is None:
+            self._reserved_names = {}
+        return self._reserved_names.setdefault(job_id, set())
+
+    def prefetch_package_states(self, package_ids=None, job_id=None):
+        '''
+        Loads the modification date, state and name of the packages with
+        the given ids, or of the packages with the same id as the guids of
+        the objects of a job, in a single query. The import stage uses them
+        to decide if packages need to be created, updated or skipped.
+
+        Returns a dict of package ids to (metadata_modified, state, name)
+        '''
+        # Use the date of the last revision of the package
+        query = Session.query(Package.id, model.Revision.timestamp,
+                              Package.state, Package.name) \
+                .outerjoin(model.Revision, Package.revision_id==model.Revision.id)
+
+        states = {}
+        if job_id:
+            query = query.join(HarvestObject, HarvestObject.guid==Package.id) \
+                    .filter(HarvestObject.harvest_job_id==job_id)
+            rows = query
+        else:
+            package_ids = list(package_ids)
+            rows = []
+            for i in range(0, len(package_ids), 1000):
+                rows.extend(query.filter(Package.id.in_(package_ids[i:i+1000])))
+
+        for package_id, timestamp, state, name in rows:
+            states[package_id] = (timestamp.isoformat() if timestamp else None,
+                                  state, name)
+        return states
+
+    def _get_package_state(self, package_id, job_id):
+        '''
+        Returns (metadata_modified, state, name) for an existing package, or
+        None if it does not exist. The states of all the packages of a job
+        are loaded the first time one of them is requested, and the guids
+        of the job without a package are remembered, so they are not looked
+        up again.
+        '''
+        if not self._package_states or self._package_states[0] != job_id:
+            states = self.prefetch_package_states(job_id=job_id)
+            # All the ids looked up so far, including the ones not found
+            checked = set(guid for (guid,) in Session.query(HarvestObject.guid) \
+                                                     .filter(HarvestObject.harvest_job_id==job_id))
+            self._package_states = (job_id, states, checked)
+
+        job_id, states, checked = self._package_states
+        if not package_id in states and not package_id in checked:
+            # The object guid may not be the package id
+            states.update(self.prefetch_package_states([package_id]))
+            checked.add(package_id)
+        return states.get(package_id)
+
+    def _set_package_state(self, package_id, job_id, state):
+        if self._package_states and self._package_states[0] == job_id:
+            self._package_states[1][package_id] = state
+
+    def _get_error_buffer(self):
+        if self._error_buffer is None:
+            try:
+                max_samples = int(ckan_config.get('ckan.harvest.error_samples', 10))
+            except ValueError:
+                max_samples = 10
+            self._error_buffer = ErrorBuffer(max_samples)
+        return self._error_buffer
+
+    def _buffer_error(self, message, job_id, stage, object_id=None):
+        error_buffer = self._get_error_buffer()
+        error_buffer.add(message, job_id, stage, object_id)
+        # Inside a unit of work, the worker flushes at the end of the batch
+        if not unit_of_work.active and len(error_buffer) >= self._get_batch_size():
+            error_buffer.flush()
 
     def _save_gather_error(self,message,job):
         '''
         Helper function to create an error during the gather stage.
+        Errors are written in bulk by flush_batch().
         '''
-        err = HarvestGatherError(message=message,job=job)
-        err.save()
+        self._buffer_error(message, job.id, u'Gather')
         log.error(message)
 
     def _save_object_error(self,message,obj,stage=u'Fetch'):
         '''
         Helper function to create an error during the fetch or import stage.
+        Errors are written in bulk by flush_batch().
         '''
-        err = HarvestObjectError(message=message,object=obj,stage=stage)
-        err.save()
+        self._buffer_error(message, obj.harvest_job_id, stage, obj.id)
         log.error(message)
 
     def _create_harvest_objects(self, remote_ids, harvest_job):
@@ -94,7 +495,196 @@ class HarvesterBase(SingletonPlugin):
         except Exception, e:
             self._save_gather_error('%r' % e.message, harvest_job)
 
-    def _create_or_update_package(self, package_dict, harvest_object):
+    def _delete_missing_packages(self, harvest_job, remote_guids, remote_count):
+        '''
+        Deletes the packages imported from the job source whose guid is not
+        in remote_guids (the complete set of remote ids), i.e. the ones
+        that have been removed from the remote source. The current objects
+        of the source are streamed from the database and compared with the
+        remote ids in a single pass, and the packages are deleted in
+        batches, each one in its own revision. The number of packages
+        deleted is stored in harvest_job.deleted_count.
+
+        remote_count is the number of packages the remote source reports.
+        Nothing is deleted unless it matches the number of remote ids, as
+        an incomplete listing would make the rest of packages look deleted.
+        The remote ids must be in the same form (e.g. ids or names) as the
+        guids of the objects.
+        '''
+        if not remote_guids:
+            # Most likely something went wrong on the remote side
+            log.warning('No remote ids received for source %s, not deleting any packages',
+                        harvest_job.source_id)
+            return 0
+
+        if remote_count is None or len(remote_guids) != remote_count:
+            log.warning('Received %i remote ids for source %s but it has %s packages, '
+                        'not deleting any packages', len(remote_guids),
+                        harvest_job.source_id, remote_count)
+            return 0
+
+        missing = [package_id for guid, package_id in
+                   Session.query(HarvestObject.guid, HarvestObject.package_id) \
+                          .filter(HarvestObject.harvest_source_id==harvest_job.source_id) \
+                          .filter(HarvestObject.current==True) \
+                          .filter(HarvestObject.package_id!=None) \
+                          .yield_per(1000)
+                   if not guid in remote_guids]
+
+        from ckanext.harvest.model import harvest_object_table
+        batch_size = self._get_batch_size()
+        deleted = 0
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+
+            rev = model.repo.new_revision()
+            rev.author = u'harvest'
+            rev.message = u'Deleted by harvest job %s, no longer on the remote source' % harvest_job.id
+
+            with self._suspend_synchronous_indexing():
+                packages = Session.query(Package).filter(Package.id.in_(batch)) \
+                                                 .filter(Package.state!=u'deleted').all()
+                package_ids = []
+                for package in packages:
+                    package.delete()
+                    for plugin in PluginImplementations(IPackageController):
+                        plugin.delete(package)
+                    package_ids.append(package.id)
+
+                # The objects no longer represent a package on the remote source
+                Session.connection().execute(
+                    update(harvest_object_table) \
+                        .where(harvest_object_table.c.package_id.in_(batch)) \
+                        .values(current=False))
+                model.repo.commit()
+            deleted += len(package_ids)
+
+            if asbool(ckan_config.get('ckan.harvest.defer_indexing', False)):
+                index_queue = self._get_index_queue()
+                for package_id in package_ids:
+                    index_queue.add(package_id)
+                index_queue.flush()
+
+        harvest_job.deleted_count = deleted
+        harvest_job.save()
+        if deleted:
+            log.info('Deleted %i packages no longer on the remote source for job %s',
+                     deleted, harvest_job.id)
+        return deleted
+
+    def _get_previous_object(self, harvest_object):
+        '''
+        Returns the current Harvest Object from the same source and with the
+        same guid as the one provided, i.e. the one that was last imported,
+        or None if there isn't one.
+        '''
+        return Session.query(HarvestObject) \
+                      .filter(HarvestObject.harvest_source_id==harvest_object.harvest_source_id) \
+                      .filter(HarvestObject.guid==harvest_object.guid) \
+                      .filter(HarvestObject.current==True) \
+                      .filter(HarvestObject.id!=harvest_object.id) \
+                      .first()
+
+    # Harvesters that save gather checkpoints and can resume an interrupted
+    # gather stage. The gather of other harvesters is started again.
+    supports_gather_checkpoints = False
+
+    def _save_harvest_objects(self, contents, harvest_job, checkpoint=None):
+        '''
+        Creates in bulk the Harvest Objects for a list of (guid, content)
+        tuples and returns their ids. Harvesters that get the contents
+        during the gather stage can store them here, and these objects are
+        marked as fetched, so the fetch stage can skip them. Use None as
+        content for the objects that still need to be fetched.
+
+        If a checkpoint is given, it is stored on the job in the same
+        transaction as the objects, so a resumed gather can start from it
+        (see _get_job_objects).
+        '''
+        from ckanext.harvest.model import harvest_object_table
+
+        now = datetime.datetime.utcnow()
+        rows = [{
+            'id': make_uuid(),
+            'guid': guid,
+            'content': content,
+            'harvest_job_id': harvest_job.id,
+            'harvest_source_id': harvest_job.source_id,
+            'current': False,
+            'gathered': now,
+            'fetch_started': now if content is not None else None,
+            'fetch_finished': now if content is not None else None,
+        } for guid, content in contents]
+
+        if rows:
+            Session.connection().execute(harvest_object_table.insert(), rows)
+        if checkpoint is not None:
+            harvest_job.gather_checkpoint = unicode(checkpoint)
+            harvest_job.gather_object_count = (harvest_job.gather_object_count or 0) + len(rows)
+        if rows or checkpoint is not None:
+            unit_of_work.commit_or_flush()
+        return [row['id'] for row in rows]
+
+    def _get_job_objects(self, harvest_job):
+        '''
+        Returns a {guid: object id} dict with the objects already created
+        for the job, ie by a gather stage that was interrupted. A resumed
+        gather skips these guids, and returns these ids along with the new
+        ones so they get fetched.
+        '''
+        return dict(Session.query(HarvestObject.guid, HarvestObject.id) \
+                           .filter(HarvestObject.harvest_job_id==harvest_job.id))
+
+    # Package schema and contexts shared by all the packages imported by
+    # this worker, contexts are keyed by (user name, API version)
+    _package_schema = None
+    _package_contexts = None
+
+    def _get_package_schema(self):
+        if self._package_schema is None:
+            # Change default schema
+            schema = default_package_schema()
+            schema['id'] = [ignore_missing, unicode]
+            schema['__junk'] = [ignore]
+            self._package_schema = schema
+        return self._package_schema
+
+    def _get_package_context(self, config=None):
+        '''
+        Returns a new context used to create and update packages with the
+        source config provided (self.config by default)
+        '''
+        if config is None:
+            config = self.config
+
+        # Check API version
+        if config:
+            api_version = config.get('api_version','2')
+            #TODO: use site user when available
+            user_name = config.get('user',u'harvest')
+        else:
+            api_version = '2'
+            user_name = u'harvest'
+
+        if self._package_contexts is None:
+            self._package_contexts = {}
+        key = (user_name, api_version)
+        if not key in self._package_contexts:
+            self._package_contexts[key] = {
+                'model': model,
+                'session': Session,
+                'user': user_name,
+                'api_version': api_version,
+                'schema': self._get_package_schema(),
+            }
+
+        # The actions add keys to the context, so don't share it
+        context = self._package_contexts[key].copy()
+        # Let the worker commit the whole batch
+        context['defer_commit'] = unit_of_work.active
+        return context
+
+    def _create_or_update_package(self, package_dict, harvest_object, config=None):
         '''
         Creates a new package or updates an exisiting one according to the
         package dictionary provided. The package dictionary should look like
@@ -109,29 +699,18 @@ class HarvesterBase(SingletonPlugin):
         If the remote server provides the modification date of the remote
         package, add it to package_dict['metadata_modified'].
 
-        '''
-        try:
-            # Change default schema
-            schema = default_package_schema()
-            schema['id'] = [ignore_missing, unicode]
-            schema['__junk'] = [ignore]
+        If ckan.harvest.bulk_import is enabled, the package is queued and
+        written later with the rest of the batch by write_packages().
 
-            # Check API version
-            if self.config:
-                api_version = self.config.get('api_version','2')
-                #TODO: use site user when available
-                user_name = self.config.get('user',u'harvest')
-            else:
-                api_version = '2'
-                user_name = u'harvest'
+        The source config (user, api_version, etc) is taken from config if
+        provided, or from self.config otherwise.
 
-            context = {
-                'model': model,
-                'session': Session,
-                'user': user_name,
-                'api_version': api_version,
-                'schema': schema,
-            }
+        '''
+        if config is None:
+            config = self.config
+
+        try:
+            context = self._get_package_context(config)
 
             tags = package_dict.get('tags', [])
             tags = [munge_tag(t) for t in tags]
@@ -139,54 +718,237 @@ class HarvesterBase(SingletonPlugin):
             package_dict['tags'] = tags
 
             # Check if package exists
-            data_dict = {}
-            data_dict['id'] = package_dict['id']
-            try:
-                existing_package_dict = get_action('package_show')(context, data_dict)
+            job_id = harvest_object.harvest_job_id
+            existing_package = self._get_package_state(package_dict['id'], job_id)
+            if existing_package:
                 # Check modified date
                 if not 'metadata_modified' in package_dict or \
-                   package_dict['metadata_modified'] > existing_package_dict.get('metadata_modified'):
+                   package_dict['metadata_modified'] > existing_package[0]:
                     log.info('Package with GUID %s exists and needs to be updated' % harvest_object.guid)
+                else:
+                    log.info('Package with GUID %s not updated, skipping...' % harvest_object.guid)
+                    self._advance_watermark(harvest_object, package_dict.get('metadata_modified'))
+                    return
+            else:
+                # Check if name has not already been used
+                package_dict['name'] = self._check_name(package_dict['name'], job_id)
+                log.info('Package with GUID %s does not exist, let\'s create it' % harvest_object.guid)
+
+            if asbool(ckan_config.get('ckan.harvest.bulk_import', False)):
+                if self._bulk_packages is None:
+                    self._bulk_packages = []
+                self._bulk_packages.append((package_dict, harvest_object,
+                                            not existing_package, config))
+                # Inside a unit of work, the worker flushes at the end of
+                # the batch
+                if not unit_of_work.active and \
+                   len(self._bulk_packages) >= self._get_batch_size():
+                    self.write_packages()
+                return True
+
+            with self._suspend_synchronous_indexing():
+                if existing_package:
                     # Update package
                     context.update({'id':package_dict['id']})
                     new_package = get_action('package_update_rest')(context, package_dict)
-
                 else:
-                    log.info('Package with GUID %s not updated, skipping...' % harvest_object.guid)
-                    return
+                    new_package = get_action('package_create_rest')(context, package_dict)
 
-            except NotFound:
-                # Package needs to be created
+            self._package_written(new_package['id'], new_package['name'],
+                                  package_dict, harvest_object, config)
+            return True
 
-                # Check if name has not already been used
-                package_dict['name'] = self._check_name(package_dict['name'])
+        except ValidationError,e:
+            log.exception(e)
+            self._save_object_error('Invalid package with GUID %s: %r'%(harvest_object.guid,e.error_dict),harvest_object,'Import')
+        except Exception, e:
+            log.exception(e)
+            self._save_object_error('%r'%e,harvest_object,'Import')
 
-                log.info('Package with GUID %s does not exist, let\'s create it' % harvest_object.guid)
-                new_package = get_action('package_create_rest')(context, package_dict)
-                harvest_object.package_id = new_package['id']
+        return None
 
-            # Flag the other objects linking to this package as not current anymore
-            from ckanext.harvest.model import harvest_object_table
-            conn = Session.connection()
-            u = update(harvest_object_table) \
-                    .where(harvest_object_table.c.package_id==bindparam('b_package_id')) \
-                    .values(current=False)
-            conn.execute(u, b_package_id=new_package['id'])
-            Session.commit()
+    def _package_written(self, package_id, package_name, package_dict, harvest_object,
+                         config=None):
+        '''
+        Called after a package has been created or updated from a harvest
+        object, with the config of its source. Links the object to the
+        package and flags it as current.
+        '''
+        if unit_of_work.active:
+            if self._written_packages is None:
+                self._written_packages = {}
+            self._written_packages[harvest_object.id] = package_id
+
+        # Don't import the same version again if it appears twice in the job
+        self._set_package_state(package_id, harvest_object.harvest_job_id,
+                (package_dict.get('metadata_modified') or datetime.datetime.now().isoformat(),
+                 u'active', package_name))
+        self._advance_watermark(harvest_object, package_dict.get('metadata_modified'))
+
+        if asbool(ckan_config.get('ckan.harvest.defer_indexing', False)):
+            index_queue = self._get_index_queue()
+            index_queue.add(package_id)
+            if not unit_of_work.active and index_queue.is_full():
+                index_queue.flush()
+
+        # Packages written in bulk also get their flags in bulk
+        if asbool(ckan_config.get('ckan.harvest.defer_current', False)) or \
+           asbool(ckan_config.get('ckan.harvest.bulk_import', False)):
+            # Record this object as the current one for the package, and
+            # link them and update the flags for the whole batch in
+            # flush_batch(), without writing or committing anything for
+            # each package
+            if self._pending_current is None:
+                self._pending_current = {}
+            self._pending_current[package_id] = harvest_object.id
+            # Inside a unit of work, the worker flushes at the end of
+            # the batch
+            if not unit_of_work.active and \
+               len(self._pending_current) >= self._get_batch_size():
+                self.flush_batch()
+
+            return
+
+        # Flag the other objects linking to this package as not current anymore
+        from ckanext.harvest.model import harvest_object_table
+        conn = Session.connection()
+        u = update(harvest_object_table) \
+                .where(harvest_object_table.c.package_id==bindparam('b_package_id')) \
+                .values(current=False)
+        conn.execute(u, b_package_id=package_id)
+        unit_of_work.commit_or_flush()
+
+        # Flag this as the current harvest object
+
+        harvest_object.package_id = package_id
+        harvest_object.current = True
+        harvest_object.save()
+
+    # Newest remote modification date imported from each source since the
+    # last flush_batch, as a dict of source id to metadata_modified
+    _pending_watermarks = None
+
+    def _advance_watermark(self, harvest_object, metadata_modified):
+        '''
+        Records the remote modification date of a package imported (or
+        found up to date) for the watermark of its source, which is saved
+        by flush_batch.
+        '''
+        if not metadata_modified:
+            return
+        if self._pending_watermarks is None:
+            self._pending_watermarks = {}
+        source_id = harvest_object.harvest_source_id
+        if metadata_modified > self._pending_watermarks.get(source_id, ''):
+            self._pending_watermarks[source_id] = metadata_modified
+
+    # Packages waiting to be written by write_packages, as tuples of
+    # (package_dict, harvest_object, is_new, config)
+    _bulk_packages = None
+
+    def write_packages(self):
+        '''
+        Writes the packages queued by _create_or_update_package when
+        ckan.harvest.bulk_import is enabled.
+
+        Instead of calling the package_create_rest and package_update_rest
+        actions for each package, all of them are validated, saved under a
+        single revision and flushed together in one transaction. Note that
+        each package is still saved through the ORM (package_dict_save), so
+        this saves the revision, commit and action overhead of every
+        package, not the statements needed to write its rows.
+
+        If this fails (e.g. there is a conflict with an existing package),
+        the batch is rolled back and the packages are written one by one
+        with the actions, each one in its own savepoint, so errors are
+        recorded against the right objects and only roll back their package.
+        '''
+        items, self._bulk_packages = self._bulk_packages or [], []
+        if not items:
+            return
 
-            # Flag this as the current harvest object
+        # A revision only has one author
+        context = self._get_package_context(items[0][3])
+        written = []
+        fallback = []
 
-            harvest_object.package_id = new_package['id']
-            harvest_object.current = True
-            harvest_object.save()
+        with self._suspend_synchronous_indexing():
+            savepoint = Session.begin_nested()
+            try:
+                rev = model.repo.new_revision()
+                rev.author = context['user']
+                rev.message = u'Harvest import of %i datasets' % len(items)
+
+                for package_dict, harvest_object, is_new, config in items:
+                    package_context = self._get_package_context(config)
+                    data = package_api_to_dict(dict(package_dict), package_context)
+                    data, errors = validate(data, package_context['schema'], package_context)
+                    if errors:
+                        # The action will record the validation errors
+                        fallback.append((package_dict, harvest_object, is_new, config))
+                        continue
+
+                    package = package_dict_save(data, package_context)
+                    if is_new:
+                        admin = model.User.by_name(package_context['user'])
+                        model.setup_default_user_roles(package, [admin] if admin else [])
+                    written.append((package, package_dict, harvest_object, is_new, config))
+
+                Session.flush()
+
+                for package, package_dict, harvest_object, is_new, config in written:
+                    for plugin in PluginImplementations(IPackageController):
+                        if is_new:
+                            plugin.create(package)
+                        else:
+                            plugin.edit(package)
+            except Exception, e:
+                log.error('Error writing a batch of %i packages, writing them one by one: %r',
+                          len(items), e)
+                Session.rollback()
+                written = []
+                fallback = items
+            else:
+                if Session.transaction is savepoint:
+                    Session.commit()
+                unit_of_work.commit_or_flush()
+                log.info('Wrote a batch of %i packages', len(written))
 
-            return True
+            for package, package_dict, harvest_object, is_new, config in written:
+                self._package_written(package.id, package.name, package_dict, harvest_object, config)
+
+            for package_dict, harvest_object, is_new, config in fallback:
+                self._write_package_with_actions(package_dict, harvest_object, is_new, config)
 
+    def _write_package_with_actions(self, package_dict, harvest_object, is_new, config):
+        # A failed write must not leave the session unusable for the rest
+        # of the batch (or make the worker commit fail)
+        savepoint = Session.begin_nested()
+        try:
+            context = self._get_package_context(config)
+            if is_new:
+                new_package = get_action('package_create_rest')(context, package_dict)
+            else:
+                context.update({'id':package_dict['id']})
+                new_package = get_action('package_update_rest')(context, package_dict)
+
+            self._package_written(new_package['id'], new_package['name'],
+                                  package_dict, harvest_object, config)
         except ValidationError,e:
             log.exception(e)
+            self._rollback_package(savepoint, harvest_object)
             self._save_object_error('Invalid package with GUID %s: %r'%(harvest_object.guid,e.error_dict),harvest_object,'Import')
         except Exception, e:
             log.exception(e)
+            self._rollback_package(savepoint, harvest_object)
             self._save_object_error('%r'%e,harvest_object,'Import')
-
-        return None
+        else:
+            # The action may have committed the savepoint already
+            if Session.transaction is savepoint:
+                Session.commit()
+            unit_of_work.commit_or_flush()
+
+    def _rollback_package(self, savepoint, harvest_object):
+        if Session.transaction is savepoint:
+            Session.rollback()
+        self.discard_object(harvest_object)
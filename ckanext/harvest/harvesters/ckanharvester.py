@@ -1,4 +1,9 @@
+import urllib
 import urllib2
+import threading
+from multiprocessing.pool import ThreadPool
+
+from pylons import config as ckan_config
 
 from ckan.lib.base import c
 from ckan import model
@@ -7,14 +12,15 @@ from ckan.logic import ValidationError, NotFound, get_action
 from ckan.lib.helpers import json
 
 from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+                                    HarvestObjectError, unit_of_work
 
 from ckanclient import CkanClient
 
 import logging
 log = logging.getLogger(__name__)
 
-from base import HarvesterBase
+from base import HarvesterBase, get_source_config, unique
+from httpclient import HTTPClient, ResponseCache, iter_json_array
 
 class CKANHarvester(HarvesterBase):
     '''
@@ -22,39 +28,130 @@ class CKANHarvester(HarvesterBase):
     '''
     config = None
 
-    api_version = '2'
+    # The search gather stores the offset of the next page as checkpoint,
+    # and all gathers skip the objects already created for the job
+    supports_gather_checkpoints = True
 
-    def _get_rest_api_offset(self):
-        return '/api/%s/rest' % self.api_version
+    api_version = '2'
 
-    def _get_search_api_offset(self):
-        return '/api/%s/search' % self.api_version
+    # Largest page of search results that can be requested
+    max_search_rows = 1000
+
+    def _get_config(self, source):
+        '''
+        Returns the parsed (and read-only) config of the source, which is
+        passed to the rest of methods instead of being stored in the
+        harvester, so it can work on several sources at the same time.
+        '''
+        return get_source_config(source.id, source.config)
+
+    def _get_api_version(self, config=None):
+        if config is None:
+            config = self.config
+        return (config or {}).get('api_version', self.api_version)
+
+    def _get_rest_api_offset(self, config=None):
+        return '/api/%s/rest' % self._get_api_version(config)
+
+    def _get_search_api_offset(self, config=None):
+        return '/api/%s/search' % self._get_api_version(config)
+
+    # HTTP clients shared by the gather and fetch stages, keyed by source id
+    _http_clients = {}
+    _http_clients_lock = threading.Lock()
+
+    _response_cache = None
+
+    def _get_response_cache(self):
+        cache_dir = ckan_config.get('ckan.harvest.http_cache_dir')
+        if cache_dir and self._response_cache is None:
+            max_size = int(ckan_config.get('ckan.harvest.http_cache_size', 100))
+            CKANHarvester._response_cache = ResponseCache(cache_dir, max_size * 1024 * 1024)
+        return self._response_cache
+
+    def _get_http_client(self, source_id=None):
+        with self._http_clients_lock:
+            if not source_id in self._http_clients:
+                self._http_clients[source_id] = HTTPClient(
+                    pool_size=int(ckan_config.get('ckan.harvest.http_pool_size', 4)),
+                    timeout=float(ckan_config.get('ckan.harvest.http_timeout', 60)),
+                    cache=self._get_response_cache())
+            return self._http_clients[source_id]
+
+    def _get_request_args(self, headers, config):
+        '''
+        Returns the HTTP client and the headers to use for a request
+        '''
+        if config is None:
+            config = self.config or {}
+        headers = dict(headers or {})
+        api_key = config.get('api_key',None)
+        if api_key:
+            headers['Authorization'] = api_key
+        return self._get_http_client(getattr(config, 'source_id', None)), headers
+
+    def _get_response(self, url, headers=None, config=None):
+        '''
+        Returns a (status, headers, body) tuple with the response for the URL
+        '''
+        http_client, headers = self._get_request_args(headers, config)
+        return http_client.get_response(url, headers)
+
+    def _get_content(self, url, config=None):
+        return self._get_response(url, config=config)[2]
+
+    def _get_json_array(self, url, config=None):
+        '''
+        Returns an iterator over the items of the JSON array at the URL,
+        which are parsed as the response is received
+        '''
+        http_client, headers = self._get_request_args(None, config)
+        return iter_json_array(http_client.stream(url, headers))
+
+    def _get_contents(self, urls, config=None):
+        '''
+        Requests the URLs using a pool of ckan.harvest.http_workers threads
+        and yields a (url, content, error) tuple for each of them, in the
+        same order. Errors are returned rather than raised, so they can be
+        saved from the calling thread.
+        '''
+        def get(url):
+            try:
+                return url, self._get_content(url, config), None
+            except Exception, e:
+                return url, None, e
 
-    def _get_content(self, url):
-        http_request = urllib2.Request(
-            url = url,
-        )
+        workers = min(int(ckan_config.get('ckan.harvest.http_workers', 4)), len(urls))
+        if workers <= 1:
+            for url in urls:
+                yield get(url)
+            return
 
+        pool = ThreadPool(workers)
         try:
-            api_key = self.config.get('api_key',None)
-            if api_key:
-                http_request.add_header('Authorization',api_key)
-            http_response = urllib2.urlopen(http_request)
-
-            return http_response.read()
-        except Exception, e:
-            raise e
-
-    def _set_config(self,config_str):
-        if config_str:
-            self.config = json.loads(config_str)
-
-            if 'api_version' in self.config:
-                self.api_version = self.config['api_version']
-
-            log.debug('Using config: %r', self.config)
-        else:
-            self.config = {}
+            for result in pool.imap(get, urls):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def flush_batch(self):
+        super(CKANHarvester, self).flush_batch()
+
+        # After the packages written in bulk by the base class
+        if self._pending_read_only:
+            self._set_read_only_roles()
+
+        for source_id, http_client in self._http_clients.items():
+            log.debug('HTTP client for source %s: %r', source_id, http_client.stats())
+
+    def _set_config(self,config_str,source_id=None):
+        '''
+        Stores the source config in the harvester. Kept for harvesters
+        based on this one, the stages use _get_config instead.
+        '''
+        self.config = get_source_config(source_id, config_str)
+        self.api_version = self.config.get('api_version', CKANHarvester.api_version)
 
     def info(self):
         return {
@@ -99,11 +196,21 @@ class CKANHarvester(HarvesterBase):
                 except NotFound,e:
                     raise ValueError('User not found')
 
-            for key in ('read_only','force_all'):
+            if 'search_rows' in config_obj:
+                if not isinstance(config_obj['search_rows'],int) or config_obj['search_rows'] < 1 \
+                   or config_obj['search_rows'] > self.max_search_rows:
+                    raise ValueError('search_rows must be an integer between 1 and %i' % \
+                                     self.max_search_rows)
+
+            for key in ('read_only','force_all','search_gather','delete_missing'):
                 if key in config_obj:
                     if not isinstance(config_obj[key],bool):
                         raise ValueError('%s must be boolean' % key)
 
+            if config_obj.get('delete_missing') and \
+               str(config_obj.get('api_version', self.api_version)) != '2':
+                raise ValueError('delete_missing requires api_version 2')
+
         except ValueError,e:
             raise e
 
@@ -115,7 +222,7 @@ class CKANHarvester(HarvesterBase):
         get_all_packages = True
         package_ids = []
 
-        self._set_config(harvest_job.source.config)
+        config = self._get_config(harvest_job.source)
 
         # Check if this source has been harvested before
         previous_job = Session.query(HarvestJob) \
@@ -127,34 +234,35 @@ class CKANHarvester(HarvesterBase):
 
         # Get source URL
         base_url = harvest_job.source.url.rstrip('/')
-        base_rest_url = base_url + self._get_rest_api_offset()
-        base_search_url = base_url + self._get_search_api_offset()
-
-        if (previous_job and not previous_job.gather_errors and not len(previous_job.objects) == 0):
-            if not self.config.get('force_all',False):
+        base_rest_url = base_url + self._get_rest_api_offset(config)
+        base_search_url = base_url + self._get_search_api_offset(config)
+
+        watermark = harvest_job.source.watermark
+        if watermark and not config.get('force_all',False):
+            # Request only the packages modified since the newest one
+            # imported from this source
+            return self._gather_with_search(base_search_url, harvest_job, config,
+                                            since=watermark)
+
+        if previous_job and not previous_job.gather_errors and \
+           Session.query(HarvestObject.id) \
+                  .filter(HarvestObject.harvest_job_id==previous_job.id).first():
+            if not config.get('force_all',False):
                 get_all_packages = False
 
                 # Request only the packages modified since last harvest job
-                last_time = harvest_job.gather_started.isoformat()
+                last_time = previous_job.gather_started.isoformat()
                 url = base_search_url + '/revision?since_time=%s' % last_time
 
                 try:
-                    content = self._get_content(url)
+                    content = self._get_content(url, config)
 
                     revision_ids = json.loads(content)
                     if len(revision_ids):
-                        for revision_id in revision_ids:
-                            url = base_rest_url + '/revision/%s' % revision_id
-                            try:
-                                content = self._get_content(url)
-                            except Exception,e:
-                                self._save_gather_error('Unable to get content for URL: %s: %s' % (url, str(e)),harvest_job)
-                                continue
-
-                            revision = json.loads(content)
-                            for package_id in revision.packages:
-                                if not package_id in package_ids:
-                                    package_ids.append(package_id)
+                        urls = [base_rest_url + '/revision/%s' % revision_id
+                                for revision_id in revision_ids]
+                        package_ids = list(unique(
+                                self._get_revision_package_ids(urls, harvest_job, config)))
                     else:
                         log.info('No packages have been updated on the remote CKAN instance since the last harvest job')
                         return None
@@ -169,55 +277,341 @@ class CKANHarvester(HarvesterBase):
 
 
 
+        if get_all_packages and config.get('search_gather',False):
+            # Get the full remote packages from the search API, so they
+            # don't need to be fetched one by one
+            return self._gather_with_search(base_search_url, harvest_job, config)
+
         if get_all_packages:
-            # Request all remote packages
+            # Request all remote packages, creating the objects as the ids
+            # are received
             url = base_rest_url + '/package'
             try:
-                content = self._get_content(url)
+                package_ids = self._get_json_array(url, config)
             except Exception,e:
                 self._save_gather_error('Unable to get content for URL: %s: %s' % (url, str(e)),harvest_job)
                 return None
 
-            package_ids = json.loads(content)
-
+        object_ids = []
         try:
-            object_ids = []
-            if len(package_ids):
-                for package_id in package_ids:
-                    # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid = package_id, job = harvest_job)
-                    obj.save()
-                    object_ids.append(obj.id)
-
+            # If the gather was interrupted, keep the objects already created
+            existing = self._get_job_objects(harvest_job)
+            object_ids = existing.values()
+            remote_guids = set()
+            # The listing is parsed as it is received, so it can still fail
+            # after some objects have been created
+            package_ids = iter(package_ids)
+            complete = True
+            while True:
+                try:
+                    package_id = package_ids.next()
+                except StopIteration:
+                    break
+                except Exception, e:
+                    self._save_gather_error('Unable to get content for URL: %s: %r' % (url, e),
+                                            harvest_job)
+                    complete = False
+                    break
+
+                if package_id in remote_guids:
+                    continue
+                remote_guids.add(package_id)
+                if package_id in existing:
+                    continue
+
+                # Create a new HarvestObject for this identifier
+                obj = HarvestObject(guid = package_id, job = harvest_job)
+                obj.save()
+                object_ids.append(obj.id)
+
+            harvest_job.gather_object_count = len(object_ids)
+            harvest_job.save()
+
+            if get_all_packages and complete:
+                # We have the complete list of remote packages
+                self._delete_missing(harvest_job, config, remote_guids,
+                                     self._get_remote_count(base_search_url, config))
+
+            if len(object_ids):
+                # Also if the listing failed, so the objects created get
+                # fetched
                 return object_ids
 
-            else:
+            elif complete:
                self._save_gather_error('No packages received for URL: %s' % url,
                        harvest_job)
-               return None
+            return None
         except Exception, e:
-            self._save_gather_error('%r'%e.message,harvest_job)
+            # The objects created before the error have been committed
+            Session.rollback()
+            self._save_gather_error('Error gathering packages from %s: %r' % (url, e),
+                                    harvest_job)
+            return object_ids or None
+
+
+    # Keys only found in the search results
+    _search_only_keys = ('data_dict', 'validated_data_dict', 'index_id',
+                         'indexed_ts', 'entity_type', 'site_id')
+
+    def _search_result_to_package_dict(self, result):
+        '''
+        Converts a package returned by the search API to the format of the
+        REST API
+        '''
+        package_dict = dict((key, value) for key, value in result.iteritems()
+                            if not key in self._search_only_keys)
+
+        tags = package_dict.get('tags') or []
+        package_dict['tags'] = [t['name'] if isinstance(t, dict) else t for t in tags]
+
+        extras = package_dict.get('extras') or {}
+        if isinstance(extras, list):
+            extras = dict((e['key'], e['value']) for e in extras)
+        package_dict['extras'] = extras
+
+        return package_dict
+
+    def _gather_with_search(self, base_search_url, harvest_job, config, since=None):
+        '''
+        Pages through the remote search API and returns the ids of the
+        harvest objects created. If the search_gather option is set, the
+        full package dicts are stored in the objects as they are received,
+        so they don't need to be fetched.
+
+        If since (a remote metadata_modified date) is provided, only the
+        packages modified since then are requested.
+
+        The offset of the next page is saved on the job as checkpoint with
+        each page of objects, so an interrupted gather carries on from
+        there.
+        '''
+        rows = min(int(config.get('search_rows', self.max_search_rows)), self.max_search_rows)
+        store_content = config.get('search_gather', False)
+        query = ''
+        if since:
+            # Solr dates don't have fractions of seconds. The range is
+            # inclusive, and packages that were already imported are
+            # skipped by the import stage.
+            query = '&q=' + urllib.quote('metadata_modified:[%sZ TO *]' % since[:19])
+
+        # Use the same guids as the REST API listings, which have package
+        # names instead of ids on version 1
+        guid_key = 'name' if str(self._get_api_version(config)) == '1' else 'id'
+
+        existing = self._get_job_objects(harvest_job)
+        object_ids = existing.values()
+        guids = set(existing)
+        offset = 0
+        if existing and harvest_job.gather_checkpoint:
+            offset = int(harvest_job.gather_checkpoint)
+            log.info('Resuming the gather of job %s at offset %i', harvest_job.id, offset)
+        count = None
+        while True:
+            url = base_search_url + '/package?all_fields=1&limit=%i&offset=%i%s' % (rows, offset, query)
+            try:
+                content = self._get_content(url, config)
+                response = json.loads(content)
+                results = response['results']
+            except Exception,e:
+                self._save_gather_error('Unable to get content for URL: %s: %s' % (url, str(e)),harvest_job)
+                return object_ids or None
+
+            contents = []
+            for result in results:
+                package_dict = self._search_result_to_package_dict(result)
+                guid = package_dict[guid_key]
+                # Packages may move between pages if they change meanwhile
+                if guid in guids:
+                    continue
+                guids.add(guid)
+                contents.append((guid, json.dumps(package_dict) if store_content else None))
+
+            # The remote site may return fewer rows than requested, so the
+            # number of packages found tells when to stop
+            count = response.get('count', count)
+            offset += len(results)
+            object_ids.extend(self._save_harvest_objects(contents, harvest_job,
+                                                         checkpoint=offset))
+
+            if not results:
+                break
+            if count is not None and offset >= count:
+                break
+            if count is None and len(results) < rows:
+                break
+
+        if not since:
+            # We have the complete list of remote packages
+            self._delete_missing(harvest_job, config, guids, count)
+
+        if not object_ids:
+            if since:
+                log.info('No packages have been updated on the remote CKAN instance since %s' % since)
+            else:
+                self._save_gather_error('No packages received for URL: %s' % url,
+                        harvest_job)
+            return None
+
+        log.info('Gathered %i packages from %s using the search API', len(object_ids), url)
+        return object_ids
 
+    def _get_remote_count(self, base_search_url, config):
+        '''
+        Returns the number of packages on the remote site, or None if it
+        can not be found
+        '''
+        url = base_search_url + '/package?limit=0'
+        try:
+            return json.loads(self._get_content(url, config))['count']
+        except Exception, e:
+            log.warning('Unable to get the number of packages from %s: %r', url, e)
+            return None
+
+    def _delete_missing(self, harvest_job, config, remote_guids, remote_count):
+        '''
+        Deletes the packages that are no longer on the remote site, if the
+        source has the delete_missing option
+        '''
+        if not config.get('delete_missing',False):
+            return
+        if str(self._get_api_version(config)) != '2':
+            # Version 1 of the REST API identifies packages by name, which
+            # changes when they are renamed
+            log.warning('delete_missing requires api_version 2, not deleting packages '
+                        'from source %s', harvest_job.source_id)
+            return
+        self._delete_missing_packages(harvest_job, remote_guids, remote_count)
+
+    def _get_revision_package_ids(self, urls, harvest_job, config):
+        '''
+        Yields the ids of the packages in the revisions at the URLs, which
+        can be repeated
+        '''
+        for revision_url, content, error in self._get_contents(urls, config):
+            if error:
+                self._save_gather_error('Unable to get content for URL: %s: %s' % (revision_url, str(error)),harvest_job)
+                continue
+
+            revision = json.loads(content)
+            for package_id in revision['packages']:
+                yield package_id
+
+    def _package_written(self, package_id, package_name, package_dict, harvest_object,
+                         config=None):
+        super(CKANHarvester, self)._package_written(package_id, package_name,
+                                                    package_dict, harvest_object, config)
+        if config is None:
+            config = self.config
+
+        # Called once the package exists, also when it is written in bulk
+        if config and config.get('read_only',False) == True:
+            # The permissions are set for the whole batch in flush_batch
+            user_name = config.get('user',u'harvest')
+            if self._pending_read_only is None:
+                self._pending_read_only = {}
+            self._pending_read_only.setdefault(user_name, []).append(package_id)
+
+            # Inside a unit of work, the worker flushes at the end of
+            # the batch
+            if not unit_of_work.active and \
+               sum(len(ids) for ids in self._pending_read_only.values()) >= self._get_batch_size():
+                self._set_read_only_roles()
+
+    def discard_object(self, harvest_object):
+        package_id = super(CKANHarvester, self).discard_object(harvest_object)
+        if package_id and self._pending_read_only:
+            for package_ids in self._pending_read_only.values():
+                while package_id in package_ids:
+                    package_ids.remove(package_id)
+        return package_id
+
+    # Packages imported from read_only sources waiting for their
+    # permissions to be set, as a dict of user name to package ids
+    _pending_read_only = None
+    # Ids of the users needed for the permissions, keyed by name
+    _user_ids = None
+
+    def _get_user_id(self, user_name):
+        if self._user_ids is None:
+            self._user_ids = {}
+        if not user_name in self._user_ids:
+            user = model.User.get(user_name)
+            self._user_ids[user_name] = user.id if user else None
+        return self._user_ids[user_name]
+
+    def _set_read_only_roles(self):
+        '''
+        Makes the packages imported from read_only sources editable only by
+        the harvest user, and readable by everyone else
+        '''
+        pending, self._pending_read_only = self._pending_read_only or {}, {}
+        for user_name, package_ids in pending.iteritems():
+            package_ids = list(unique(package_ids))
+
+            # Clear default permissions
+            roles = Session.query(model.PackageRole) \
+                           .filter(model.PackageRole.package_id.in_(package_ids)) \
+                           .filter(model.PackageRole.user_id!=None)
+            for role in roles:
+                Session.delete(role)
+
+            # Setup harvest user as admin and other users can only read
+            user_roles = [(self._get_user_id(user_name), model.Role.ADMIN),
+                          (self._get_user_id(u'visitor'), model.Role.READER),
+                          (self._get_user_id(u'logged_in'), model.Role.READER)]
+            for package_id in package_ids:
+                for user_id, role in user_roles:
+                    if user_id:
+                        Session.add(model.PackageRole(package_id=package_id,
+                                                      user_id=user_id, role=role))
+
+            log.debug('Set read only permissions for %i packages', len(package_ids))
+
+        if pending:
+            unit_of_work.commit_or_flush()
 
     def fetch_stage(self,harvest_object):
         log.debug('In CKANHarvester fetch_stage')
 
-        self._set_config(harvest_object.job.source.config)
+        config = self._get_config(harvest_object.job.source)
+
+        if harvest_object.content is not None:
+            # Already fetched when gathering with the search API
+            return True
 
         # Get source URL
         url = harvest_object.source.url.rstrip('/')
-        url = url + self._get_rest_api_offset() + '/package/' + harvest_object.guid
+        url = url + self._get_rest_api_offset(config) + '/package/' + harvest_object.guid
+
+        # Only get the package if it changed since it was last imported
+        previous_object = self._get_previous_object(harvest_object)
+        headers = {}
+        if previous_object:
+            if previous_object.etag:
+                headers['If-None-Match'] = previous_object.etag
+            if previous_object.last_modified:
+                headers['If-Modified-Since'] = previous_object.last_modified
 
         # Get contents
         try:
-            content = self._get_content(url)
+            status, response_headers, content = self._get_response(url, headers, config)
         except Exception,e:
             self._save_object_error('Unable to get content for package: %s: %r' % \
                                         (url, e),harvest_object)
             return None
 
+        if status == 304:
+            log.debug('Package with GUID %s not modified, skipping import' % harvest_object.guid)
+            harvest_object.content = previous_object.content
+            harvest_object.etag = previous_object.etag
+            harvest_object.last_modified = previous_object.last_modified
+            harvest_object.save()
+            return False
+
         # Save the fetched contents in the HarvestObject
         harvest_object.content = content
+        harvest_object.etag = response_headers.get('etag')
+        harvest_object.last_modified = response_headers.get('last-modified')
         harvest_object.save()
         return True
 
@@ -232,32 +626,32 @@ class CKANHarvester(HarvesterBase):
                     harvest_object, 'Import')
             return False
 
-        self._set_config(harvest_object.job.source.config)
+        config = self._get_config(harvest_object.job.source)
 
         try:
             package_dict = json.loads(harvest_object.content)
 
             # Set default tags if needed
-            default_tags = self.config.get('default_tags',[])
+            default_tags = config.get('default_tags',[])
             if default_tags:
                 if not 'tags' in package_dict:
                     package_dict['tags'] = []
                 package_dict['tags'].extend([t for t in default_tags if t not in package_dict['tags']])
 
             # Ignore remote groups for the time being
-            del package_dict['groups']
+            package_dict.pop('groups', None)
 
             # Set default groups if needed
-            default_groups = self.config.get('default_groups',[])
+            default_groups = config.get('default_groups',[])
             if default_groups:
                 if not 'groups' in package_dict:
                     package_dict['groups'] = []
                 package_dict['groups'].extend([g for g in default_groups if g not in package_dict['groups']])
 
             # Set default extras if needed
-            default_extras = self.config.get('default_extras',{})
+            default_extras = config.get('default_extras',{})
             if default_extras:
-                override_extras = self.config.get('override_extras',False)
+                override_extras = config.get('override_extras',False)
                 if not 'extras' in package_dict:
                     package_dict['extras'] = {}
                 for key,value in default_extras.iteritems():
@@ -273,25 +667,7 @@ class CKANHarvester(HarvesterBase):
 
                         package_dict['extras'][key] = value
 
-            result = self._create_or_update_package(package_dict,harvest_object)
-
-            if result and self.config.get('read_only',False) == True:
-
-                package = model.Package.get(package_dict['id'])
-
-                # Clear default permissions
-                model.clear_user_roles(package)
-
-                # Setup harvest user as admin
-                user_name = self.config.get('user',u'harvest')
-                user = model.User.get(user_name)
-                pkg_role = model.PackageRole(package=package, user=user, role=model.Role.ADMIN)
-
-                # Other users can only read
-                for user_name in (u'visitor',u'logged_in'):
-                    user = model.User.get(user_name)
-                    pkg_role = model.PackageRole(package=package, user=user, role=model.Role.READER)
-
+            self._create_or_update_package(package_dict,harvest_object,config)
 
         except ValidationError,e:
             self._save_object_error('Invalid package with GUID %s: %r' % (harvest_object.guid, e.error_dict),
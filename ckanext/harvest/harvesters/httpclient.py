@@ -0,0 +1,433 @@
+import os
+import re
+import socket
+import base64
+import hashlib
+import zlib
+import httplib
+import urllib
+import urllib2
+import urlparse
+import threading
+import logging
+from Queue import Queue, Empty, Full
+from StringIO import StringIO
+
+from ckan.lib.helpers import json
+
+log = logging.getLogger(__name__)
+
+__all__ = ['HTTPClient', 'ResponseCache', 'iter_json_array']
+
+
+class HTTPClient(object):
+    '''
+    HTTP client that keeps a pool of persistent (keep-alive) connections
+    per host, so requests to the same remote server reuse the TCP
+    connection (and the TLS session for https) instead of opening a new
+    one each time. It can be shared between threads.
+
+    Responses are requested compressed with gzip, and decompressed
+    transparently. Responses with a status code of 400 or above raise
+    urllib2.HTTPError,
+    like urllib2.urlopen does. If a ResponseCache is provided, successful
+    responses are stored in it and later requests to the same URL are
+    answered from it.
+
+    Like urllib2, requests go through the proxies defined in the
+    environment (http_proxy, https_proxy and no_proxy) unless a dict of
+    proxies (as returned by urllib.getproxies) is provided.
+    '''
+
+    max_redirects = 5
+
+    def __init__(self, pool_size=4, timeout=60, cache=None, proxies=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache = cache
+        self.proxies = urllib.getproxies() if proxies is None else proxies
+        self.pools = {}
+        self.opened = 0
+        self.reused = 0
+        self.requests = 0
+        self.cached = 0
+        self._lock = threading.Lock()
+
+    def _get_pool(self, key):
+        with self._lock:
+            if not key in self.pools:
+                self.pools[key] = Queue(self.pool_size)
+            return self.pools[key]
+
+    def _get_proxy(self, scheme, host):
+        '''
+        Returns the (host, port, Proxy-Authorization header) of the proxy
+        to use for the host, or None if it must be connected directly
+        '''
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+        if not '://' in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlsplit(proxy)
+        auth = None
+        if parts.username:
+            credentials = '%s:%s' % (urllib.unquote(parts.username),
+                                     urllib.unquote(parts.password or ''))
+            auth = 'Basic ' + base64.b64encode(credentials)
+        return parts.hostname, parts.port or 80, auth
+
+    def _get_key(self, url):
+        '''
+        Returns the key of the pool of connections for the URL, a tuple of
+        (scheme, host, port, proxy)
+        '''
+        parts = urlparse.urlsplit(url)
+        return (parts.scheme, parts.hostname, parts.port,
+                self._get_proxy(parts.scheme, parts.hostname))
+
+    def _get_connection(self, key):
+        try:
+            connection = self._get_pool(key).get_nowait()
+            with self._lock:
+                self.reused += 1
+            return connection, True
+        except Empty:
+            return self._new_connection(key), False
+
+    def _new_connection(self, key):
+        scheme, host, port, proxy = key
+        connection_class = httplib.HTTPSConnection if scheme == 'https' \
+                           else httplib.HTTPConnection
+        if proxy:
+            proxy_host, proxy_port, proxy_auth = proxy
+            connection = connection_class(proxy_host, proxy_port, timeout=self.timeout)
+            if scheme == 'https':
+                # Tunnel the TLS connection through the proxy with CONNECT
+                headers = {'Proxy-Authorization': proxy_auth} if proxy_auth else None
+                connection.set_tunnel(host, port, headers)
+        else:
+            connection = connection_class(host, port, timeout=self.timeout)
+        with self._lock:
+            self.opened += 1
+        return connection
+
+    def _discard_pool(self, key):
+        '''
+        Closes the idle connections to a host, e.g. when one of them has
+        been closed by the server, as the others have probably been idle
+        for as long
+        '''
+        pool = self._get_pool(key)
+        while True:
+            try:
+                pool.get_nowait().close()
+            except Empty:
+                break
+
+    def _release_connection(self, key, connection):
+        try:
+            self._get_pool(key).put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def _send(self, key, path, headers):
+        '''
+        Sends the request and returns the connection and the response,
+        which still needs to be read.
+        '''
+        connection, reused = self._get_connection(key)
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection, connection.getresponse()
+        except (httplib.HTTPException, socket.error), e:
+            connection.close()
+            if not reused:
+                raise
+            # The server closed the persistent connection, try again with
+            # a new one
+            log.debug('Persistent connection to %s lost, reconnecting: %r', key[1], e)
+            self._discard_pool(key)
+            connection = self._new_connection(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                return connection, connection.getresponse()
+            except:
+                connection.close()
+                raise
+
+    def _done(self, key, connection, response):
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(key, connection)
+
+    def _open(self, url, headers):
+        '''
+        Sends the request, following redirects, and returns the URL, key,
+        connection and response. Raises urllib2.HTTPError for errors.
+        '''
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'gzip'
+        for i in range(self.max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            key = self._get_key(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            request_headers = headers
+            proxy = key[3]
+            if proxy and parts.scheme == 'http':
+                # Plain HTTP proxies get the absolute URL
+                path = urlparse.urlunsplit((parts.scheme, parts.netloc, path, '', ''))
+                if proxy[2]:
+                    request_headers = dict(headers)
+                    request_headers['Proxy-Authorization'] = proxy[2]
+
+            with self._lock:
+                self.requests += 1
+            connection, response = self._send(key, path, request_headers)
+
+            if response.status in (301, 302, 303, 307) and response.getheader('location') \
+               or response.status >= 400:
+                try:
+                    body = self._decode(response, response.read())
+                finally:
+                    self._done(key, connection, response)
+
+                if response.status >= 400:
+                    raise urllib2.HTTPError(url, response.status, response.reason,
+                                            response.msg, StringIO(body))
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+
+            return url, key, connection, response
+
+        raise urllib2.HTTPError(url, response.status, 'Too many redirects',
+                                response.msg, StringIO(body))
+
+    def _decode(self, response, body):
+        if response.getheader('content-encoding') == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def get_response(self, url, headers=None):
+        '''
+        Makes a GET request to the URL, following redirects, and returns a
+        (status, headers, body) tuple. Header names are lower case.
+        '''
+        if self.cache:
+            body = self.cache.get(url)
+            if body is not None:
+                with self._lock:
+                    self.cached += 1
+                return 200, {}, body
+
+        final_url, key, connection, response = self._open(url, headers)
+        try:
+            body = self._decode(response, response.read())
+        except:
+            connection.close()
+            raise
+        self._done(key, connection, response)
+
+        if self.cache and response.status == 200:
+            self.cache.set(url, body)
+        return response.status, dict(response.getheaders()), body
+
+    def get(self, url, headers=None):
+        '''
+        Returns the body of the response to a GET request to the URL,
+        following redirects.
+        '''
+        return self.get_response(url, headers)[2]
+
+    def stream(self, url, headers=None, chunk_size=64 * 1024):
+        '''
+        Like get, but returns an iterator over the body, which is read (and
+        decompressed) chunk_size bytes at a time, so big responses don't
+        need to be held in memory. The request is made straight away, so
+        errors are raised by this method.
+        '''
+        if self.cache:
+            body = self.cache.get(url)
+            if body is not None:
+                with self._lock:
+                    self.cached += 1
+                return iter([body])
+
+        final_url, key, connection, response = self._open(url, headers)
+
+        def chunks():
+            decompressor = None
+            if response.getheader('content-encoding') == 'gzip':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            finished = False
+            try:
+                while True:
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    if decompressor:
+                        chunk = decompressor.decompress(chunk)
+                    if chunk:
+                        yield chunk
+                if decompressor:
+                    chunk = decompressor.flush()
+                    if chunk:
+                        yield chunk
+                finished = True
+            finally:
+                if finished:
+                    self._done(key, connection, response)
+                else:
+                    # Not read completely, so it can't be reused
+                    connection.close()
+
+        return chunks()
+
+    def stats(self):
+        return {'requests': self.requests,
+                'cached': self.cached,
+                'connections_opened': self.opened,
+                'connections_reused': self.reused}
+
+    def close(self):
+        with self._lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except Empty:
+                    break
+
+
+class ResponseCache(object):
+    '''
+    Stores response bodies on disk, one file per URL. When the files take
+    more than max_size bytes, the least recently written ones are removed.
+    Meant for development and for re-running harvests, as cached responses
+    never expire.
+    '''
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum(os.path.getsize(path) for path in self._paths())
+
+    def _paths(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.md5(url).hexdigest())
+
+    def get(self, url):
+        try:
+            f = open(self._path(url), 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def set(self, url, body):
+        if len(body) > self.max_size:
+            return
+        path = self._path(url)
+        with self._lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            # Write to a temporary file first, so readers never get a
+            # partial body
+            tmp_path = '%s.%i.tmp' % (path, threading.current_thread().ident)
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+            self.size += len(body)
+
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Remove the oldest files until the cache is down to 90% of its size
+        paths = sorted(self._paths(), key=os.path.getmtime)
+        for path in paths:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+def iter_json_array(chunks):
+    '''
+    Parses a JSON array received in several chunks of text, yielding each
+    of its items as soon as it has been received, so the whole array never
+    needs to be held in memory.
+    '''
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    more = True
+    # One of 'start', 'first' (item or end), 'item', 'separator' or 'end'
+    expecting = 'start'
+    while True:
+        pos = _whitespace.match(buf, pos).end()
+        if pos < len(buf):
+            if expecting == 'item' or expecting == 'first' and buf[pos] != ']':
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    end = None
+                # A number is only complete if something that can't be
+                # part of it follows, otherwise it may continue in the
+                # next chunk
+                if end is not None and (not more or \
+                                        not isinstance(value, (int, long, float)) or \
+                                        end < len(buf) and buf[end] in ' \t\n\r,]'):
+                    yield value
+                    pos = end
+                    expecting = 'separator'
+                    continue
+                if not more:
+                    raise ValueError('Invalid item in JSON array')
+            else:
+                char = buf[pos]
+                if expecting == 'start' and char == '[':
+                    expecting = 'first'
+                elif expecting in ('first', 'separator') and char == ']':
+                    expecting = 'end'
+                elif expecting == 'separator' and char == ',':
+                    expecting = 'item'
+                elif expecting == 'end':
+                    # Ignore anything after the array
+                    return
+                else:
+                    raise ValueError('Unexpected %r in JSON array' % char)
+                pos += 1
+                continue
+
+        # More data is needed
+        if not more:
+            if expecting == 'end':
+                return
+            raise ValueError('Unexpected end of JSON array')
+        try:
+            buf = buf[pos:] + chunks.next()
+            pos = 0
+        except StopIteration:
+            more = False
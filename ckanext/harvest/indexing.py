@@ -0,0 +1,207 @@
+import time
+import inspect
+import logging
+import threading
+from contextlib import contextmanager
+
+from ckan import model
+from ckan.lib.dictization.model_dictize import package_dictize
+
+log = logging.getLogger(__name__)
+
+__all__ = ['IndexQueue', 'SearchIndex', 'LocalSearchIndex', 'get_search_index',
+           'synchronous_indexing_suspended']
+
+
+class SearchIndex(object):
+    '''
+    Indexes packages in the CKAN search index, committing only when
+    commit() is called if the CKAN version supports it.
+    '''
+
+    def __init__(self, index=None):
+        if index is None:
+            from ckan.lib.search import index_for
+            index = index_for('Package')
+        self.index = index
+        self.defer_commit = _accepts_argument(index.index_package, 'defer_commit') and \
+                            hasattr(index, 'commit')
+        if not self.defer_commit:
+            log.warning('This version of CKAN commits the search index after every '
+                        'package, the harvested packages will not be indexed in batches')
+
+    def index_package(self, package_dict):
+        if self.defer_commit:
+            self.index.index_package(package_dict, defer_commit=True)
+        else:
+            self.index.index_package(package_dict)
+
+    def remove_package(self, package_dict):
+        self.index.remove_dict(package_dict)
+
+    def commit(self):
+        if self.defer_commit:
+            self.index.commit()
+
+
+def _accepts_argument(function, name):
+    try:
+        args, varargs, keywords, defaults = inspect.getargspec(function)
+    except TypeError:
+        return False
+    return name in args or keywords is not None
+
+
+class LocalSearchIndex(object):
+    '''
+    Stand-in search index that keeps the package dicts in memory, for tests
+    and development.
+    '''
+
+    def __init__(self):
+        self.packages = {}
+        self.uncommitted = {}
+        self.commits = 0
+
+    def index_package(self, package_dict):
+        self.uncommitted[package_dict['id']] = package_dict
+
+    def remove_package(self, package_dict):
+        self.uncommitted[package_dict['id']] = None
+
+    def commit(self):
+        for package_id, package_dict in self.uncommitted.items():
+            if package_dict is None:
+                self.packages.pop(package_id, None)
+            else:
+                self.packages[package_id] = package_dict
+        self.uncommitted = {}
+        self.commits += 1
+
+
+def get_search_index(name):
+    if name == 'local':
+        return LocalSearchIndex()
+    return SearchIndex()
+
+
+# Threads writing packages that the IndexQueue will index
+_suspended = threading.local()
+_patch_lock = threading.Lock()
+
+def _get_synchronous_search_plugin():
+    try:
+        from ckan.lib.search import SynchronousSearchPlugin
+    except ImportError:
+        return None
+    # It is a singleton, this is the instance CKAN notifies
+    return SynchronousSearchPlugin()
+
+def _skip_when_suspended(method):
+    def wrapper(*args, **kwargs):
+        if getattr(_suspended, 'depth', 0):
+            return
+        return method(*args, **kwargs)
+    return wrapper
+
+def _patch_synchronous_search():
+    plugin = _get_synchronous_search_plugin()
+    if plugin is None or getattr(plugin, '_harvest_patched', False):
+        return
+    with _patch_lock:
+        if getattr(plugin, '_harvest_patched', False):
+            return
+        # Depending on the CKAN version, the packages are indexed when the
+        # session is committed (notify) or by the package actions
+        for name in ('notify', 'create', 'edit', 'delete'):
+            if hasattr(plugin, name):
+                setattr(plugin, name, _skip_when_suspended(getattr(plugin, name)))
+        plugin._harvest_patched = True
+
+@contextmanager
+def synchronous_indexing_suspended(suspend=True):
+    '''
+    Stops the synchronous_search plugin from indexing the packages written
+    by the current thread inside the with block, as the IndexQueue will
+    index them. Packages written by other threads (e.g. edits on the web
+    interface) are still indexed as usual.
+    '''
+    if not suspend:
+        yield
+        return
+
+    _patch_synchronous_search()
+    _suspended.depth = getattr(_suspended, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _suspended.depth -= 1
+
+
+def _load_packages(package_ids):
+    '''
+    Returns a dict of package ids to package dicts, loading all the packages
+    in a single query. Packages that don't exist are left out.
+    '''
+    context = {'model': model, 'session': model.Session}
+    packages = model.Session.query(model.Package).filter(model.Package.id.in_(package_ids))
+    return dict((package.id, package_dictize(package, context)) for package in packages)
+
+
+class IndexQueue(object):
+    '''
+    Collects the ids of the packages created or updated during a harvest job
+    and indexes them in batches, committing the search index once per batch
+    instead of once per package. The packages of each batch are loaded with
+    a single query. The time spent indexing is kept in index_time (seconds).
+    '''
+
+    def __init__(self, index, batch_size=100, load_packages=_load_packages):
+        self.index = index
+        self.batch_size = batch_size
+        self.load_packages = load_packages
+        self.pending = []
+        self.pending_ids = set()
+        self.indexed = 0
+        self.index_time = 0.0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, package_id):
+        if not package_id in self.pending_ids:
+            self.pending.append(package_id)
+            self.pending_ids.add(package_id)
+
+    def discard(self, package_id):
+        if package_id in self.pending_ids:
+            self.pending.remove(package_id)
+            self.pending_ids.remove(package_id)
+
+    def is_full(self):
+        return len(self.pending) >= self.batch_size
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, []
+        self.pending_ids = set()
+        start = time.time()
+        package_dicts = self.load_packages(pending)
+        for package_id in pending:
+            package_dict = package_dicts.get(package_id)
+            if package_dict is None:
+                # The transaction that created it was rolled back
+                continue
+            if package_dict.get('state') == u'deleted':
+                self.index.remove_package(package_dict)
+            else:
+                self.index.index_package(package_dict)
+        self.index.commit()
+
+        elapsed = time.time() - start
+        self.indexed += len(pending)
+        self.index_time += elapsed
+        log.info('Indexed %i packages in %.2f seconds (%i packages in %.2f seconds in total)',
+                 len(pending), elapsed, self.indexed, self.index_time)
@@ -1,17 +1,20 @@
 import logging
-from sqlalchemy import or_
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import subqueryload
 from ckan.authz import Authorizer
-from ckan.model import User
+from ckan.model import User, Group
 
 from ckan.plugins import PluginImplementations
 from ckanext.harvest.interfaces import IHarvester
 
 
-from ckan.logic import NotFound, check_access
+from ckan.logic import NotFound, ValidationError, check_access
 
 from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject)
 from ckanext.harvest.logic.dictization import (harvest_source_dictize,
+                                               harvest_sources_status,
                                                harvest_job_dictize,
+                                               harvest_job_object_counts,
                                                harvest_object_dictize)
 
 log = logging.getLogger(__name__)
@@ -39,8 +42,18 @@ def harvest_source_list(context, data_dict):
 
     sources = _get_sources_for_user(context, data_dict)
 
+    # Get all the publisher titles in one go
+    publisher_ids = set([source.publisher_id for source in sources if source.publisher_id])
+    publisher_titles = {}
+    if publisher_ids:
+        publisher_titles = dict(session.query(Group.id,Group.title) \
+                                .filter(Group.id.in_(publisher_ids)))
+
+    # Get the status of all the sources with a few grouped queries
     context.update({'detailed':False})
-    return [harvest_source_dictize(source, context) for source in sources]
+    statuses = harvest_sources_status(session, [source.id for source in sources])
+    return [harvest_source_dictize(source, context, publisher_titles, statuses[source.id])
+            for source in sources]
 
 def harvest_source_for_a_dataset(context, data_dict):
     '''For a given dataset, return the harvest source that
@@ -69,13 +82,28 @@ def harvest_job_show(context,data_dict):
     id = data_dict.get('id')
     attr = data_dict.get('attr',None)
 
-    job = HarvestJob.get(id,attr=attr)
+    query = HarvestJob.filter(**{attr or 'id': id}).options(subqueryload('gather_errors'))
+    if not context.get('summary'):
+        query = query.options(subqueryload('objects'))
+    job = query.first()
     if not job:
         raise NotFound
 
     return harvest_job_dictize(job,context)
 
 def harvest_job_list(context,data_dict):
+    '''
+        Returns the harvest jobs, optionally filtered by source_id and status,
+        ordered by creation date ('order' can be 'asc' or 'desc').
+
+        If 'limit' is provided, only a page of jobs is returned, in a dict
+        with the jobs in 'results' and the cursor for the next page in
+        'next' (None on the last page). Pass this cursor as 'after' to get
+        the following page.
+
+        If the 'summary' context flag is set, the jobs include the number of
+        objects instead of the objects (see harvest_job_dictize).
+    '''
 
     check_access('harvest_job_list',context,data_dict)
 
@@ -84,8 +112,13 @@ def harvest_job_list(context,data_dict):
 
     source_id = data_dict.get('source_id',False)
     status = data_dict.get('status',False)
+    limit, after, order = _get_page_params(data_dict)
+
+    summary = context.get('summary',False)
 
-    query = session.query(HarvestJob)
+    query = session.query(HarvestJob).options(subqueryload('gather_errors'))
+    if not summary:
+        query = query.options(subqueryload('objects'))
 
     if source_id:
         query = query.filter(HarvestJob.source_id==source_id)
@@ -93,9 +126,34 @@ def harvest_job_list(context,data_dict):
     if status:
         query = query.filter(HarvestJob.status==status)
 
-    jobs = query.all()
+    order_columns = [HarvestJob.created, HarvestJob.id]
+    if after:
+        after_values = session.query(*order_columns) \
+                .filter(HarvestJob.id==after).first()
+        if not after_values:
+            raise ValidationError({'after': ['Unknown harvest job: %s' % after]})
+        query = query.filter(_keyset_filter(order_columns, after_values, order))
+
+    query = _keyset_order(query, order_columns, order)
+
+    if limit is None:
+        return _harvest_jobs_dictize(query.all(), context)
+
+    jobs = query.limit(limit + 1).all()
+    next = jobs[limit - 1].id if len(jobs) > limit else None
 
-    return [harvest_job_dictize(job,context) for job in jobs]
+    return {
+        'results': _harvest_jobs_dictize(jobs[:limit], context),
+        'next': next,
+    }
+
+def _harvest_jobs_dictize(jobs, context):
+    if not context.get('summary'):
+        return [harvest_job_dictize(job,context) for job in jobs]
+
+    # Count the objects of all the jobs at once
+    counts = harvest_job_object_counts(context['session'], [job.id for job in jobs])
+    return [harvest_job_dictize(job,context,counts=counts[job.id]) for job in jobs]
 
 def harvest_object_show(context,data_dict):
 
@@ -103,13 +161,23 @@ def harvest_object_show(context,data_dict):
 
     id = data_dict.get('id')
     attr = data_dict.get('attr',None)
-    obj = HarvestObject.get(id,attr=attr)
+    obj = HarvestObject.filter(**{attr or 'id': id}) \
+            .options(subqueryload('errors')) \
+            .first()
     if not obj:
         raise NotFound
 
     return harvest_object_dictize(obj,context)
 
 def harvest_object_list(context,data_dict):
+    '''
+        Returns the ids of the harvest objects, optionally filtered by
+        source_id and only_current (True by default), ordered by id.
+
+        Accepts the same 'limit', 'after' and 'order' parameters as
+        harvest_job_list, in which case a dict with 'results' and 'next' is
+        returned.
+    '''
 
     check_access('harvest_object_list',context,data_dict)
 
@@ -118,18 +186,33 @@ def harvest_object_list(context,data_dict):
 
     only_current = data_dict.get('only_current',True)
     source_id = data_dict.get('source_id',False)
+    limit, after, order = _get_page_params(data_dict)
 
-    query = session.query(HarvestObject)
+    # Only the ids are returned, so don't load the whole objects
+    query = session.query(HarvestObject.id)
 
     if source_id:
-        query = query.filter(HarvestObject.source_id==source_id)
+        query = query.filter(HarvestObject.harvest_source_id==source_id)
 
     if only_current:
         query = query.filter(HarvestObject.current==True)
 
-    objects = query.all()
+    order_columns = [HarvestObject.id]
+    if after:
+        query = query.filter(_keyset_filter(order_columns, [after], order))
+
+    query = _keyset_order(query, order_columns, order)
 
-    return [getattr(obj,'id') for obj in objects]
+    if limit is None:
+        return [obj_id for obj_id, in query]
+
+    object_ids = [obj_id for obj_id, in query.limit(limit + 1)]
+    next = object_ids[limit - 1] if len(object_ids) > limit else None
+
+    return {
+        'results': object_ids[:limit],
+        'next': next,
+    }
 
 def harvesters_info_show(context,data_dict):
 
@@ -186,3 +269,40 @@ def _get_sources_for_user(context,data_dict):
 
     return sources
 
+def _get_page_params(data_dict):
+
+    limit = data_dict.get('limit',None)
+    if limit is not None:
+        try:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            raise ValidationError({'limit': ['Must be a positive integer']})
+
+    order = data_dict.get('order','asc')
+    if not order in ('asc','desc'):
+        raise ValidationError({'order': ['Must be "asc" or "desc"']})
+
+    return limit, data_dict.get('after',None), order
+
+def _keyset_filter(columns, values, order):
+    '''
+    Returns a condition selecting the rows that come after the provided
+    values in the ordering defined by the columns, e.g. for two columns
+    (a > x) OR (a = x AND b > y)
+    '''
+    clauses = []
+    for i, column in enumerate(columns):
+        conditions = [c == v for c, v in zip(columns[:i], values[:i])]
+        if order == 'desc':
+            conditions.append(column < values[i])
+        else:
+            conditions.append(column > values[i])
+        clauses.append(and_(*conditions))
+    return or_(*clauses)
+
+def _keyset_order(query, columns, order):
+    if order == 'desc':
+        return query.order_by(*[column.desc() for column in columns])
+    return query.order_by(*[column.asc() for column in columns])
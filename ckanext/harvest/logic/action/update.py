@@ -10,7 +10,7 @@ from ckan.model import Package
 from ckan.logic import NotFound, ValidationError, check_access
 from ckan.lib.navl.dictization_functions import validate
 
-from ckanext.harvest.queue import get_gather_publisher
+from ckanext.harvest.queue import get_gather_publisher, flush_harvesters
 
 from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject)
 from ckanext.harvest.logic.schema import default_harvest_source_schema
@@ -129,6 +129,10 @@ def harvest_objects_import(context,data_dict):
                 harvester.import_stage(obj)
                 break
         last_objects_count += 1
+
+    # Write any work deferred by the harvesters
+    flush_harvesters()
+
     log.info('Harvest objects imported: %s', last_objects_count)
     return last_objects_count
 
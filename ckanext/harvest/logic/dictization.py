@@ -1,72 +1,235 @@
-from sqlalchemy import distinct
+from sqlalchemy import distinct, func, case, and_
+from sqlalchemy.orm import aliased
 
 from ckan.model import Package,Group
 from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, \
                                   HarvestGatherError, HarvestObjectError
+from ckanext.harvest import model as harvest_model
 
 
-def harvest_source_dictize(source, context):
+def harvest_source_dictize(source, context, publisher_titles=None, status=None):
+    '''
+    publisher_titles can be a dict of publisher ids to titles, loaded in
+    advance when dictizing several sources, to avoid a query per source.
+    Likewise, status can be the status of the source, as returned by
+    harvest_sources_status.
+    '''
     out = source.as_dict()
 
     out['publisher_title'] = u''
 
     publisher_id = out.get('publisher_id')
     if publisher_id:
-        group  = Group.get(publisher_id)
-        if group:
-            out['publisher_title'] = group.title
+        if publisher_titles is not None:
+            out['publisher_title'] = publisher_titles.get(publisher_id,u'')
+        else:
+            group  = Group.get(publisher_id)
+            if group:
+                out['publisher_title'] = group.title
 
-    out['status'] = _get_source_status(source, context)
+    if status is None:
+        status = _get_source_status(source, context)
+    out['status'] = status
 
 
     return out
 
-def harvest_job_dictize(job, context):
+def harvest_job_dictize(job, context, objects=None, gather_errors=None, counts=None):
+    '''
+    objects and gather_errors can be provided if they have already been
+    loaded, otherwise the job relationships are used (make sure they are
+    eagerly loaded when dictizing several jobs).
+
+    If the 'summary' context flag is set, the objects are not dictized, and
+    their counts are returned instead (see harvest_job_object_counts).
+    counts can be provided when dictizing several jobs.
+    '''
     out = job.as_dict()
     out['source'] = job.source_id
-    out['objects'] = []
     out['gather_errors'] = []
 
-    for obj in job.objects:
-        out['objects'].append(obj.as_dict())
+    if context.get('summary'):
+        if counts is None:
+            session = context.get('session') or context['model'].Session
+            counts = harvest_job_object_counts(session, [job.id]).get(job.id)
+        out.update(counts or _empty_counts())
+    else:
+        out['objects'] = []
+        if objects is None:
+            objects = job.objects
+        for obj in objects:
+            out['objects'].append(obj.as_dict())
+
+    if gather_errors is None:
+        gather_errors = job.gather_errors
 
-    for error in job.gather_errors:
+    for error in gather_errors:
         out['gather_errors'].append(error.as_dict())
 
     return out
 
-def harvest_object_dictize(obj, context):
+def _empty_counts():
+    return {'object_count': 0, 'fetched_count': 0, 'imported_count': 0}
+
+def harvest_job_object_counts(session, job_ids):
+    '''
+    Returns a dict with the number of objects, fetched objects and objects
+    linked to a package for each of the job ids, using a single query
+    grouped by job.
+    '''
+    if not job_ids:
+        return {}
+    query = session.query(HarvestObject.harvest_job_id,
+                          func.count(HarvestObject.id),
+                          func.count(HarvestObject.fetch_finished),
+                          func.count(HarvestObject.package_id)) \
+            .filter(HarvestObject.harvest_job_id.in_(job_ids)) \
+            .group_by(HarvestObject.harvest_job_id)
+
+    counts = dict((job_id, _empty_counts()) for job_id in job_ids)
+    for job_id, objects, fetched, imported in query:
+        counts[job_id] = {'object_count': objects,
+                          'fetched_count': fetched,
+                          'imported_count': imported}
+    return counts
+
+def harvest_object_dictize(obj, context, errors=None):
     out = obj.as_dict()
     out['source'] = obj.harvest_source_id
     out['job'] = obj.harvest_job_id
 
-    if obj.package:
-        out['package'] = obj.package.id
+    # Use the foreign key rather than loading the package
+    if obj.package_id:
+        out['package'] = obj.package_id
 
     out['errors'] = []
 
-    for error in obj.errors:
+    if errors is None:
+        errors = obj.errors
+
+    for error in errors:
         out['errors'].append(error.as_dict())
 
     return out
 
+def _empty_source_status():
+    return {
+           'job_count': 0,
+           'next_harvest':'',
+           'last_harvest_request':'',
+           'last_harvest_statistics':{'added':0,'updated':0,'deleted':0,'errors':0},
+           'last_harvest_errors':{'gather':[],'object':[],'summary':[]},
+           'overall_statistics':{'added':0, 'errors':0},
+           'packages':[]}
+
+def harvest_sources_status(session, source_ids):
+    '''
+    Returns a dict with the status of each of the sources, as returned by
+    _get_source_status when not detailed, computed for all the sources at
+    once with a fixed number of grouped queries.
+    '''
+    statuses = dict((source_id, _empty_source_status()) for source_id in source_ids)
+    if not source_ids:
+        return statuses
+
+    def grouped(query, column):
+        return dict(query.group_by(column))
+
+    job_counts = grouped(session.query(HarvestJob.source_id, func.count(HarvestJob.id)) \
+                                .filter(HarvestJob.source_id.in_(source_ids)),
+                         HarvestJob.source_id)
+    scheduled = set(source_id for (source_id,) in
+                    session.query(distinct(HarvestJob.source_id)) \
+                           .filter(HarvestJob.source_id.in_(source_ids)) \
+                           .filter(HarvestJob.status==u'New'))
+
+    # The last finished job of each source
+    newest = session.query(HarvestJob.source_id.label('source_id'),
+                           func.max(HarvestJob.created).label('created')) \
+                    .filter(HarvestJob.source_id.in_(source_ids)) \
+                    .filter(HarvestJob.status==u'Finished') \
+                    .group_by(HarvestJob.source_id).subquery()
+    last_jobs = dict((job.source_id, job) for job in
+                     session.query(HarvestJob) \
+                            .join(newest, and_(HarvestJob.source_id==newest.c.source_id,
+                                               HarvestJob.created==newest.c.created)))
+    last_job_ids = [job.id for job in last_jobs.values()] or [None]
+
+    # Errors of the last jobs, and of all the jobs of each source. Errors
+    # with a fingerprint are just a sample of the ones in the summary.
+    summary_table = harvest_model.harvest_error_summary_table
+    last_errors = {}
+    overall_errors = {}
+    for counts, group_column, query in (
+        (last_errors, HarvestGatherError.harvest_job_id,
+         session.query(HarvestGatherError.harvest_job_id, func.count(HarvestGatherError.id)) \
+                .filter(HarvestGatherError.harvest_job_id.in_(last_job_ids)) \
+                .filter(HarvestGatherError.fingerprint==None)),
+        (last_errors, HarvestObject.harvest_job_id,
+         session.query(HarvestObject.harvest_job_id, func.count(HarvestObjectError.id)) \
+                .select_from(HarvestObjectError).join(HarvestObjectError.object) \
+                .filter(HarvestObject.harvest_job_id.in_(last_job_ids)) \
+                .filter(HarvestObjectError.fingerprint==None)),
+        (last_errors, summary_table.c.harvest_job_id,
+         session.query(summary_table.c.harvest_job_id, func.sum(summary_table.c.count)) \
+                .filter(summary_table.c.harvest_job_id.in_(last_job_ids))),
+        (overall_errors, HarvestJob.source_id,
+         session.query(HarvestJob.source_id, func.count(HarvestGatherError.id)) \
+                .select_from(HarvestGatherError).join(HarvestGatherError.job) \
+                .filter(HarvestJob.source_id.in_(source_ids)) \
+                .filter(HarvestGatherError.fingerprint==None)),
+        (overall_errors, HarvestJob.source_id,
+         session.query(HarvestJob.source_id, func.count(HarvestObjectError.id)) \
+                .select_from(HarvestObjectError) \
+                .join(HarvestObjectError.object).join(HarvestObject.job) \
+                .filter(HarvestJob.source_id.in_(source_ids)) \
+                .filter(HarvestObjectError.fingerprint==None)),
+        (overall_errors, HarvestJob.source_id,
+         session.query(HarvestJob.source_id, func.sum(summary_table.c.count)) \
+                .join(summary_table, HarvestJob.id==summary_table.c.harvest_job_id) \
+                .filter(HarvestJob.source_id.in_(source_ids))),
+        ):
+        for key, count in query.group_by(group_column):
+            counts[key] = counts.get(key, 0) + int(count or 0)
+
+    packages = grouped(session.query(HarvestObject.harvest_source_id,
+                                     func.count(distinct(HarvestObject.package_id))) \
+                              .join(Package, Package.id==HarvestObject.package_id) \
+                              .filter(HarvestObject.harvest_source_id.in_(source_ids)) \
+                              .filter(HarvestObject.current==True) \
+                              .filter(Package.state==u'active'),
+                       HarvestObject.harvest_source_id)
+
+    for source_id, out in statuses.iteritems():
+        if not job_counts.get(source_id):
+            out['msg'] = 'No jobs yet'
+            continue
+        out['job_count'] = job_counts[source_id]
+        out['next_harvest'] = 'Scheduled' if source_id in scheduled else 'Not yet scheduled'
+
+        last_job = last_jobs.get(source_id)
+        if not last_job:
+            out['last_harvest_request'] = 'Not yet harvested'
+            continue
+        out['last_harvest_request'] = str(last_job.gather_finished)
+        out['last_harvest_statistics']['deleted'] = last_job.deleted_count or 0
+        out['last_harvest_statistics']['errors'] = last_errors.get(last_job.id, 0)
+        out['overall_statistics']['added'] = packages.get(source_id, 0)
+        out['overall_statistics']['errors'] = overall_errors.get(source_id, 0)
+
+    return statuses
+
 def _get_source_status(source, context):
 
     model = context.get('model')
     detailed = context.get('detailed',True)
 
-    out = dict()
+    if not detailed:
+        return harvest_sources_status(model.Session, [source.id])[source.id]
 
     job_count = HarvestJob.filter(source=source).count()
 
-    out = {
-           'job_count': 0,
-           'next_harvest':'',
-           'last_harvest_request':'',
-           'last_harvest_statistics':{'added':0,'updated':0,'errors':0},
-           'last_harvest_errors':{'gather':[],'object':[]},
-           'overall_statistics':{'added':0, 'errors':0},
-           'packages':[]}
+    out = _empty_source_status()
 
     if not job_count:
         out['msg'] = 'No jobs yet'
@@ -88,29 +251,12 @@ def _get_source_status(source, context):
     if last_job:
         #TODO: Should we encode the dates as strings?
         out['last_harvest_request'] = str(last_job.gather_finished)
+        out['last_harvest_statistics']['deleted'] = last_job.deleted_count or 0
 
-        #Get HarvestObjects from last job whit links to packages
         if detailed:
-            last_objects = [obj for obj in last_job.objects if obj.package is not None]
-
-            if len(last_objects) == 0:
-                # No packages added or updated
-                out['last_harvest_statistics']['added'] = 0
-                out['last_harvest_statistics']['updated'] = 0
-            else:
-                # Check wether packages were added or updated
-                for last_object in last_objects:
-                    # Check if the same package had been linked before
-                    previous_objects = model.Session.query(HarvestObject) \
-                                             .filter(HarvestObject.package==last_object.package) \
-                                             .count()
-
-                    if previous_objects == 1:
-                        # It didn't previously exist, it has been added
-                        out['last_harvest_statistics']['added'] += 1
-                    else:
-                        # Pacakge already existed, but it has been updated
-                        out['last_harvest_statistics']['updated'] += 1
+            added, updated = _get_added_updated(model, last_job)
+            out['last_harvest_statistics']['added'] = added
+            out['last_harvest_statistics']['updated'] = updated
 
         # Last harvest errors
         # We have the gathering errors in last_job.gather_errors, so let's also
@@ -118,9 +264,16 @@ def _get_source_status(source, context):
         object_errors = model.Session.query(HarvestObjectError).join(HarvestObject) \
                             .filter(HarvestObject.job==last_job)
 
-        out['last_harvest_statistics']['errors'] = len(last_job.gather_errors) \
-                                            + object_errors.count()
+        # Errors with a fingerprint are just a sample of the ones counted in
+        # the error summary
+        error_summary = _get_error_summary(model, last_job)
+        out['last_harvest_statistics']['errors'] = \
+                len([e for e in last_job.gather_errors if not e.fingerprint]) \
+                + object_errors.filter(HarvestObjectError.fingerprint==None).count() \
+                + sum([error['count'] for error in error_summary])
         if detailed:
+            out['last_harvest_errors']['summary'] = error_summary
+
             for gather_error in last_job.gather_errors:
                 out['last_harvest_errors']['gather'].append(gather_error.message)
 
@@ -142,14 +295,72 @@ def _get_source_status(source, context):
 
         gather_errors = model.Session.query(HarvestGatherError) \
                 .join(HarvestJob).join(HarvestSource) \
-                .filter(HarvestJob.source==source).count()
+                .filter(HarvestJob.source==source) \
+                .filter(HarvestGatherError.fingerprint==None).count()
 
         object_errors = model.Session.query(HarvestObjectError) \
                 .join(HarvestObject).join(HarvestJob).join(HarvestSource) \
-                .filter(HarvestJob.source==source).count()
-        out['overall_statistics']['errors'] = gather_errors + object_errors
+                .filter(HarvestJob.source==source) \
+                .filter(HarvestObjectError.fingerprint==None).count()
+
+        summary_table = harvest_model.harvest_error_summary_table
+        summarised_errors = model.Session.query(func.sum(summary_table.c.count)) \
+                .join(HarvestJob, HarvestJob.id==summary_table.c.harvest_job_id) \
+                .filter(HarvestJob.source==source).scalar() or 0
+
+        out['overall_statistics']['errors'] = gather_errors + object_errors \
+                                              + summarised_errors
     else:
         out['last_harvest_request'] = 'Not yet harvested'
 
     return out
 
+def _get_added_updated(model, job):
+    '''
+    Returns the number of packages added and updated by a job. A package
+    was added if the job object is the only one linked to it, and updated
+    otherwise. Counted with a single query.
+    '''
+    previous = aliased(HarvestObject)
+    objects = model.Session.query(HarvestObject.id.label('id'),
+                                  func.count(previous.id).label('links')) \
+            .join(previous, previous.package_id==HarvestObject.package_id) \
+            .filter(HarvestObject.harvest_job_id==job.id) \
+            .filter(HarvestObject.package_id!=None) \
+            .group_by(HarvestObject.id) \
+            .subquery()
+
+    total, added = model.Session.query(func.count(objects.c.id),
+                                       func.sum(case([(objects.c.links==1, 1)], else_=0))) \
+            .one()
+    added = int(added or 0)
+    return added, total - added
+
+def _get_error_summary(model, job):
+    '''
+    Returns the errors of a job grouped by fingerprint, most frequent first
+    '''
+    table = harvest_model.harvest_error_summary_table
+    query = model.Session.query(table.c.stage,
+                                table.c.fingerprint,
+                                func.min(table.c.message),
+                                func.sum(table.c.count),
+                                func.min(table.c.first_seen),
+                                func.max(table.c.last_seen),
+                                func.min(table.c.sample_object_ids)) \
+            .filter(table.c.harvest_job_id==job.id) \
+            .group_by(table.c.stage, table.c.fingerprint) \
+            .order_by(func.sum(table.c.count).desc())
+
+    summary = []
+    for stage, fingerprint, message, count, first_seen, last_seen, sample_ids in query:
+        summary.append({
+            'stage': stage,
+            'fingerprint': fingerprint,
+            'message': message,
+            'count': int(count),
+            'first_seen': first_seen.isoformat() if first_seen else None,
+            'last_seen': last_seen.isoformat() if last_seen else None,
+            'sample_object_ids': sample_ids.split() if sample_ids else [],
+        })
+    return summary
@@ -5,8 +5,12 @@ from sqlalchemy import event
 from sqlalchemy import distinct
 from sqlalchemy import Table
 from sqlalchemy import Column
+from sqlalchemy import Index
 from sqlalchemy import ForeignKey
 from sqlalchemy import types
+from sqlalchemy import select
+from sqlalchemy import update, case, and_, or_, bindparam
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.orm import backref, relation
 
@@ -28,6 +32,9 @@ __all__ = [
     'HarvestObject', 'harvest_object_table',
     'HarvestGatherError', 'harvest_gather_error_table',
     'HarvestObjectError', 'harvest_object_error_table',
+    'harvest_schema_version_table',
+    'harvest_error_summary_table',
+    'unit_of_work',
 ]
 
 
@@ -36,47 +43,198 @@ harvest_job_table = None
 harvest_object_table = None
 harvest_gather_error_table = None
 harvest_object_error_table = None
+harvest_schema_version_table = None
+harvest_error_summary_table = None
 
-def setup():
+def setup(upgrade=False):
+    '''
+    Defines the harvest tables, and creates them if they don't exist yet.
+
+    Pending schema migrations are only applied if upgrade is True (i.e. by
+    the initdb command), otherwise a warning is logged, and the consumers
+    refuse to start (see check_schema_version). Startup only costs a single
+    primary key lookup, and the processes started at the same time don't
+    try to migrate the tables concurrently.
+    '''
 
     if harvest_source_table is None:
         define_harvester_tables()
         log.debug('Harvest tables defined in memory')
 
     if model.package_table.exists():
-        if not harvest_source_table.exists():
-
-            # Create each table individually rather than
-            # using metadata.create_all()
-            harvest_source_table.create()
-            harvest_job_table.create()
-            harvest_object_table.create()
-            harvest_gather_error_table.create()
-            harvest_object_error_table.create()
-
-            log.debug('Harvest tables created')
-        else:
-            from ckan.model.meta import engine
+        # A single primary key lookup tells us whether the tables exist
+        # and which migrations they need
+        version = get_schema_version()
+
+        if version is None:
+            if not harvest_source_table.exists():
+
+                # Create each table individually rather than
+                # using metadata.create_all()
+                harvest_source_table.create()
+                harvest_job_table.create()
+                harvest_object_table.create()
+                harvest_gather_error_table.create()
+                harvest_object_error_table.create()
+                harvest_error_summary_table.create()
+                harvest_schema_version_table.create()
+
+                # New tables already have the latest schema
+                _set_schema_version(SCHEMA_VERSION)
+                Session.commit()
+
+                log.debug('Harvest tables created')
+                return
+            elif upgrade:
+                # Tables created before the schema was versioned
+                version = _get_legacy_schema_version()
+                harvest_schema_version_table.create()
+                _set_schema_version(version)
+                Session.commit()
+
+        if version is not None and version >= SCHEMA_VERSION:
             log.debug('Harvest tables already exist')
-            # Check if existing tables need to be updated
-            inspector = Inspector.from_engine(engine)
-            columns = inspector.get_columns('harvest_source')
-            if not 'title' in [column['name'] for column in columns]:
-                log.debug('Harvest tables need to be updated')
-                migrate_v2()
+        elif upgrade:
+            log.debug('Harvest tables need to be updated')
+            migrate()
+        else:
+            log.warning('The harvest tables need to be upgraded to v%i, please run '
+                        '"paster harvester initdb"', SCHEMA_VERSION)
 
     else:
         log.debug('Harvest table creation deferred')
 
+def get_schema_version():
+    '''
+    Returns the schema version stored in the database, or None if the
+    version table does not exist yet.
+    '''
+    from ckan.model.meta import engine
+    query = select([harvest_schema_version_table.c.version]) \
+            .where(harvest_schema_version_table.c.id==1)
+    try:
+        row = engine.execute(query).first()
+    except DBAPIError:
+        return None
+    return row[0] if row else None
+
+def check_schema_version():
+    '''
+    Raises HarvestError if the harvest tables don't have the schema version
+    the model expects, e.g. if the extension was upgraded but the initdb
+    command was not run. Otherwise queries on the new columns would fail
+    later with less helpful errors.
+    '''
+    version = get_schema_version()
+    if version is None or version < SCHEMA_VERSION:
+        raise HarvestError('The harvest tables are at v%s but v%i is needed, please run '
+                           '"paster harvester initdb"' % (version, SCHEMA_VERSION))
+
+def _set_schema_version(version):
+    conn = Session.connection()
+    table = harvest_schema_version_table
+    result = conn.execute(table.update().where(table.c.id==1).values(version=version))
+    if not result.rowcount:
+        conn.execute(table.insert().values(id=1, version=version))
+
+def _get_legacy_schema_version():
+    '''
+    Works out the version of tables created before harvest_schema_version
+    existed. This reflection only happens once, on the first upgrade.
+    '''
+    from ckan.model.meta import engine
+    inspector = Inspector.from_engine(engine)
+    columns = inspector.get_columns('harvest_source')
+    if not 'title' in [column['name'] for column in columns]:
+        return 1
+    return 2
+
+def _lock_schema_version():
+    '''
+    Returns the schema version, locking its row until the end of the
+    transaction
+    '''
+    table = harvest_schema_version_table
+    query = select([table.c.version], table.c.id==1, for_update=True)
+    return Session.connection().execute(query).scalar()
+
+def migrate():
+    '''
+    Applies in order all the migrations newer than the current schema
+    version. Each migration is committed together with the new schema
+    version, and the version row is locked (and read again) before
+    applying it, so if several processes run this at the same time, each
+    migration is still only applied once.
+    '''
+    for version, migration in MIGRATIONS:
+        if version <= _lock_schema_version():
+            # Applied already, maybe by another process
+            Session.commit()
+            continue
+        migration()
+        _set_schema_version(version)
+        Session.commit()
+        log.info('Harvest tables migrated to v%i', version)
+
 
 class HarvestError(Exception):
     pass
 
+class UnitOfWork(object):
+    '''
+    Groups the processing of several harvest objects in a single
+    transaction. Each object is processed inside a savepoint, so an error
+    only rolls back the changes made for that object. While a unit of work
+    is active, harvest objects are just flushed when saved, and committed
+    all together by commit().
+    '''
+    active = False
+
+    def begin(self):
+        self.active = True
+
+    def savepoint(self):
+        if not self.active:
+            return None
+        return Session.begin_nested()
+
+    def release(self, savepoint):
+        # Something may have committed the savepoint already
+        if savepoint is not None and Session.transaction is savepoint:
+            Session.commit()
+
+    def rollback(self, savepoint):
+        if savepoint is not None and Session.transaction is savepoint:
+            Session.rollback()
+
+    def commit(self):
+        self.active = False
+        Session.commit()
+
+    def commit_or_flush(self):
+        '''
+        To be used instead of Session.commit() in code that can run inside
+        a unit of work.
+        '''
+        if self.active:
+            Session.flush()
+        else:
+            Session.commit()
+
+unit_of_work = UnitOfWork()
+
 class HarvestDomainObject(DomainObject):
     '''Convenience methods for searching objects
     '''
     key_attr = 'id'
 
+    def save(self):
+        if unit_of_work.active:
+            self.add()
+            Session.flush()
+        else:
+            super(HarvestDomainObject, self).save()
+
     @classmethod
     def get(cls, key, default=None, attr=None):
         '''Finds a single entity in the register.'''
@@ -135,6 +293,61 @@ class HarvestObjectError(HarvestDomainObject):
     '''
     pass
 
+def update_current_flags(current_objects):
+    '''
+    Takes a dict of package ids to the id of the harvest object that last
+    imported them, links these objects to their packages, and in a single
+    statement flags them as current and all the other objects linked to the
+    same packages as not current.
+    '''
+    if not current_objects:
+        return
+
+    table = harvest_object_table
+    conn = Session.connection()
+    conn.execute(update(table).where(table.c.id==bindparam('b_id')) \
+                              .values(package_id=bindparam('b_package_id')),
+                 [{'b_id': object_id, 'b_package_id': package_id}
+                  for package_id, object_id in current_objects.iteritems()])
+    u = update(table) \
+        .where(table.c.package_id.in_(current_objects.keys())) \
+        .values(current=case([(table.c.id.in_(current_objects.values()), True)],
+                             else_=False))
+    conn.execute(u)
+    unit_of_work.commit_or_flush()
+
+def save_errors(gather_errors, object_errors, summaries):
+    '''
+    Inserts in bulk lists of dicts with the values of gather errors, object
+    errors and error summaries (see HarvesterBase._get_error_buffer)
+    '''
+    conn = Session.connection()
+    for table, rows in ((harvest_gather_error_table, gather_errors),
+                        (harvest_object_error_table, object_errors),
+                        (harvest_error_summary_table, summaries)):
+        if rows:
+            conn.execute(table.insert(), rows)
+    unit_of_work.commit_or_flush()
+
+def update_watermarks(watermarks):
+    '''
+    Takes a dict of source ids to the newest remote modification date
+    (metadata_modified) imported from each source, and moves the watermark
+    of the sources forward to it. Watermarks never go back.
+    '''
+    if not watermarks:
+        return
+
+    table = harvest_source_table
+    conn = Session.connection()
+    for source_id, watermark in watermarks.iteritems():
+        u = update(table) \
+            .where(and_(table.c.id==source_id,
+                        or_(table.c.watermark==None, table.c.watermark<watermark))) \
+            .values(watermark=watermark)
+        conn.execute(u)
+    unit_of_work.commit_or_flush()
+
 def harvest_object_before_insert_listener(mapper,connection,target):
     '''
         For compatibility with old harvesters, check if the source id has
@@ -154,6 +367,8 @@ def define_harvester_tables():
     global harvest_object_table
     global harvest_gather_error_table
     global harvest_object_error_table
+    global harvest_schema_version_table
+    global harvest_error_summary_table
 
     harvest_source_table = Table('harvest_source', metadata,
         Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
@@ -166,6 +381,9 @@ def define_harvester_tables():
         Column('active',types.Boolean,default=True),
         Column('user_id', types.UnicodeText, default=u''),
         Column('publisher_id', types.UnicodeText, default=u''),
+        # Remote modification date of the newest dataset imported, used
+        # to request only the datasets changed since then
+        Column('watermark', types.UnicodeText, nullable=True),
     )
     # Was harvesting_job
     harvest_job_table = Table('harvest_job', metadata,
@@ -175,6 +393,12 @@ def define_harvester_tables():
         Column('gather_finished', types.DateTime),
         Column('source_id', types.UnicodeText, ForeignKey('harvest_source.id')),
         Column('status', types.UnicodeText, default=u'New', nullable=False),
+        # Packages deleted because they are no longer on the remote source
+        Column('deleted_count', types.Integer, default=0),
+        # Progress of the gather stage, so it can be resumed if interrupted.
+        # The checkpoint format depends on the harvester.
+        Column('gather_checkpoint', types.UnicodeText, nullable=True),
+        Column('gather_object_count', types.Integer, default=0),
     )
     # Was harvested_document
     harvest_object_table = Table('harvest_object', metadata,
@@ -190,13 +414,21 @@ def define_harvester_tables():
         Column('harvest_job_id', types.UnicodeText, ForeignKey('harvest_job.id')),
         Column('harvest_source_id', types.UnicodeText, ForeignKey('harvest_source.id')),
         Column('package_id', types.UnicodeText, ForeignKey('package.id'), nullable=True),
+        # HTTP validators of the fetched content, for conditional requests
+        Column('etag', types.UnicodeText, nullable=True),
+        Column('last_modified', types.UnicodeText, nullable=True),
     )
+    Index('idx_harvest_object_source_guid', harvest_object_table.c.harvest_source_id,
+                                            harvest_object_table.c.guid)
+    Index('idx_harvest_object_job', harvest_object_table.c.harvest_job_id)
+    Index('idx_harvest_object_package', harvest_object_table.c.package_id)
     # New table
     harvest_gather_error_table = Table('harvest_gather_error',metadata,
         Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
         Column('harvest_job_id', types.UnicodeText, ForeignKey('harvest_job.id')),
         Column('message', types.UnicodeText),
         Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Column('fingerprint', types.UnicodeText),
     )
     # New table
     harvest_object_error_table = Table('harvest_object_error',metadata,
@@ -205,6 +437,27 @@ def define_harvester_tables():
         Column('message',types.UnicodeText),
         Column('stage', types.UnicodeText),
         Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Column('fingerprint', types.UnicodeText),
+    )
+    # Counts of similar errors in a job. Only a sample of them are stored in
+    # the error tables. There can be several rows for the same fingerprint,
+    # so they need to be grouped.
+    harvest_error_summary_table = Table('harvest_error_summary',metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('harvest_job_id', types.UnicodeText, ForeignKey('harvest_job.id')),
+        Column('stage', types.UnicodeText),
+        Column('fingerprint', types.UnicodeText),
+        Column('message', types.UnicodeText),
+        Column('count', types.Integer, default=0),
+        Column('first_seen', types.DateTime),
+        Column('last_seen', types.DateTime),
+        Column('sample_object_ids', types.UnicodeText, default=u''),
+    )
+    Index('idx_harvest_error_summary_job', harvest_error_summary_table.c.harvest_job_id)
+    # Single row holding the version of the harvest tables
+    harvest_schema_version_table = Table('harvest_schema_version',metadata,
+        Column('id', types.Integer, primary_key=True),
+        Column('version', types.Integer, nullable=False),
     )
 
     mapper(
@@ -310,5 +563,69 @@ def migrate_v2():
 
     conn.execute('UPDATE harvest_object SET current = FALSE WHERE current IS NOT TRUE')
 
-    Session.commit()
-    log.info('Harvest tables migrated to v2')
+def migrate_v3():
+    log.debug('Migrating harvest tables to v3')
+    conn = Session.connection()
+
+    statements = '''
+    ALTER TABLE harvest_gather_error ADD COLUMN fingerprint text;
+    ALTER TABLE harvest_object_error ADD COLUMN fingerprint text;
+    '''
+    conn.execute(statements)
+
+    harvest_error_summary_table.create(bind=conn)
+
+def migrate_v4():
+    log.debug('Migrating harvest tables to v4')
+    conn = Session.connection()
+
+    statements = '''
+    ALTER TABLE harvest_object ADD COLUMN etag text;
+    ALTER TABLE harvest_object ADD COLUMN last_modified text;
+    CREATE INDEX idx_harvest_object_source_guid ON harvest_object (harvest_source_id, guid);
+    '''
+    conn.execute(statements)
+
+def migrate_v5():
+    log.debug('Migrating harvest tables to v5')
+    conn = Session.connection()
+
+    conn.execute('ALTER TABLE harvest_source ADD COLUMN watermark text')
+
+def migrate_v6():
+    log.debug('Migrating harvest tables to v6')
+    conn = Session.connection()
+
+    conn.execute('ALTER TABLE harvest_job ADD COLUMN deleted_count integer DEFAULT 0')
+
+def migrate_v7():
+    log.debug('Migrating harvest tables to v7')
+    conn = Session.connection()
+
+    statements = '''
+    ALTER TABLE harvest_job ADD COLUMN gather_checkpoint text;
+    ALTER TABLE harvest_job ADD COLUMN gather_object_count integer DEFAULT 0;
+    CREATE INDEX idx_harvest_object_job ON harvest_object (harvest_job_id);
+    '''
+    conn.execute(statements)
+
+def migrate_v8():
+    log.debug('Migrating harvest tables to v8')
+    conn = Session.connection()
+
+    conn.execute('CREATE INDEX idx_harvest_object_package ON harvest_object (package_id)')
+
+
+# Schema migrations, as (version, function) pairs. Add new ones at the end
+# and they will be applied by the initdb command on existing databases.
+MIGRATIONS = [
+    (2, migrate_v2),
+    (3, migrate_v3),
+    (4, migrate_v4),
+    (5, migrate_v5),
+    (6, migrate_v6),
+    (7, migrate_v7),
+    (8, migrate_v8),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
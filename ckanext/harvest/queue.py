@@ -1,21 +1,27 @@
 import logging
 import datetime
+import time
 
 from carrot.connection import BrokerConnection
 from carrot.messaging import Publisher
 from carrot.messaging import Consumer
 
+from paste.deploy.converters import asbool
+
 from ckan.lib.base import config
 from ckan.plugins import PluginImplementations
 
-from ckanext.harvest.model import HarvestJob, HarvestObject,HarvestGatherError
+from ckanext.harvest.model import HarvestJob, HarvestObject,HarvestGatherError, \
+                                  HarvestObjectError, unit_of_work, \
+                                  check_schema_version
 from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.indexing import synchronous_indexing_suspended
 
 log = logging.getLogger(__name__)
 assert not log.disabled
 
 __all__ = ['get_gather_publisher', 'get_gather_consumer', \
-           'get_fetch_publisher', 'get_fetch_consumer']
+           'get_fetch_publisher', 'get_fetch_consumer', 'consume']
 
 PORT = 5672
 USERID = 'guest'
@@ -80,17 +86,49 @@ def gather_callback(message_data,message):
             for harvester in PluginImplementations(IHarvester):
                 if harvester.info()['name'] == job.source.type:
                     harvester_found = True
+                    if job.status == u'Finished':
+                        log.info('Harvest job %s has already been gathered' % job.id)
+                        break
+                    if job.gather_finished:
+                        # The gather finished but the objects may not all
+                        # have been sent to the fetch queue
+                        harvest_object_ids = _get_unfetched_object_ids(job)
+                        log.info('Sending again the %i objects of job %s not fetched yet' % \
+                                 (len(harvest_object_ids), job.id))
+                        _send_objects(publisher, harvest_object_ids)
+                        break
+
+                    if job.gather_started:
+                        # The worker was stopped while gathering this job
+                        if getattr(harvester, 'supports_gather_checkpoints', False):
+                            log.info('Resuming the gather of job %s (%i objects created so far)' % \
+                                     (job.id, job.gather_object_count or 0))
+                        else:
+                            log.info('Restarting the gather of job %s' % job.id)
+                            _delete_job_objects(job)
+                    else:
+                        # Saved straight away, so an interrupted gather can
+                        # be detected
+                        job.gather_started = datetime.datetime.now()
+                        job.save()
+
                     # Get a list of harvest object ids from the plugin
-                    job.gather_started = datetime.datetime.now()
-                    harvest_object_ids = harvester.gather_stage(job)
+                    try:
+                        harvest_object_ids = harvester.gather_stage(job)
+                    except:
+                        # Write the errors that explain the failure, in a
+                        # new transaction in case it was a database error
+                        from ckan.model import Session
+                        Session.rollback()
+                        raise
+                    finally:
+                        if hasattr(harvester,'flush_batch'):
+                            harvester.flush_batch()
                     job.gather_finished = datetime.datetime.now()
                     job.save()
                     log.debug('Received from plugin''s gather_stage: %r' % harvest_object_ids)
                     if harvest_object_ids and len(harvest_object_ids) > 0:
-                        for id in harvest_object_ids:
-                            # Send the id to the fetch queue
-                            publisher.send({'harvest_object_id':id})
-                            log.debug('Sent object %s to the fetch queue' % id)
+                        _send_objects(publisher, harvest_object_ids)
 
             if not harvester_found:
                 msg = 'No harvester could be found for source type %s' % job.source.type
@@ -109,6 +147,47 @@ def gather_callback(message_data,message):
     finally:
         message.ack()
 
+def _send_objects(publisher, harvest_object_ids):
+    for id in harvest_object_ids:
+        # Send the id to the fetch queue
+        publisher.send({'harvest_object_id':id})
+        log.debug('Sent object %s to the fetch queue' % id)
+
+def _get_unfetched_object_ids(job):
+    '''
+    Returns the ids of the objects of the job that the fetch stage has not
+    started to process, and may not have been sent to the fetch queue. The
+    objects whose content was stored by the gather stage have the same
+    fetch_started and gathered dates until they are fetched.
+    '''
+    from ckan.model import Session
+    from sqlalchemy import or_
+    return [id for (id,) in Session.query(HarvestObject.id) \
+                                   .filter(HarvestObject.harvest_job_id==job.id) \
+                                   .filter(or_(HarvestObject.fetch_started==None,
+                                               HarvestObject.fetch_started==HarvestObject.gathered)) \
+                                   .filter(~HarvestObject.errors.any())]
+
+def _delete_job_objects(job):
+    '''
+    Deletes the objects created by an interrupted gather, so they are not
+    duplicated when it is run again. They were never sent to the fetch
+    queue.
+    '''
+    from ckan.model import Session
+    object_ids = Session.query(HarvestObject.id) \
+                        .filter(HarvestObject.harvest_job_id==job.id).subquery()
+    Session.query(HarvestObjectError) \
+           .filter(HarvestObjectError.harvest_object_id.in_(object_ids)) \
+           .delete(synchronize_session=False)
+    Session.query(HarvestObject) \
+           .filter(HarvestObject.harvest_job_id==job.id) \
+           .delete(synchronize_session=False)
+    job.gather_checkpoint = None
+    job.gather_object_count = 0
+    job.save()
+
+
 
 def fetch_callback(message_data,message):
     try:
@@ -126,30 +205,123 @@ def fetch_callback(message_data,message):
             for harvester in PluginImplementations(IHarvester):
                 if harvester.info()['name'] == obj.source.type:
 
-                    # See if the plugin can fetch the harvest object
-                    obj.fetch_started = datetime.datetime.now()
-                    success = harvester.fetch_stage(obj)
-                    obj.fetch_finished = datetime.datetime.now()
-                    obj.save()
-                    #TODO: retry times?
-                    if success:
-                        # If no errors where found, call the import method
-                        harvester.import_stage(obj)
+                    # When batching objects, only roll back the changes
+                    # for this one if something goes wrong
+                    savepoint = unit_of_work.savepoint()
+                    try:
+                        # See if the plugin can fetch the harvest object
+                        obj.fetch_started = datetime.datetime.now()
+                        success = harvester.fetch_stage(obj)
+                        obj.fetch_finished = datetime.datetime.now()
+                        obj.save()
+                        #TODO: retry times?
+                        if success:
+                            # If no errors where found, call the import method
+                            harvester.import_stage(obj)
+
+                        unit_of_work.release(savepoint)
+                    except Exception, e:
+                        if savepoint is None:
+                            raise
+                        log.exception(e)
+                        unit_of_work.rollback(savepoint)
+                        # Don't write later what was deferred for it either
+                        if hasattr(harvester,'discard_object'):
+                            harvester.discard_object(obj)
+                        err = HarvestObjectError(message='%r' % e,object=obj,stage=u'Fetch')
+                        err.save()
 
 
 
     except KeyError:
         log.error('No harvest object id received')
     finally:
-        message.ack()
+        if unit_of_work.active:
+            # Acknowledged once the batch is committed
+            _pending_messages.append(message)
+        else:
+            message.ack()
+
+# Messages processed in the current unit of work
+_pending_messages = []
+
+def flush_harvesters():
+    '''
+    Lets the harvesters write any work they deferred while processing
+    the previous objects (see HarvesterBase.flush_batch)
+    '''
+    for harvester in PluginImplementations(IHarvester):
+        if hasattr(harvester,'flush_batch'):
+            harvester.flush_batch()
+
+def _end_batch():
+    flush_harvesters()
+
+    if not unit_of_work.active:
+        return
+
+    global _pending_messages
+    messages, _pending_messages = _pending_messages, []
+    try:
+        # With deferred indexing, the harvesters index the packages of the
+        # batch once it is committed
+        with synchronous_indexing_suspended(
+                asbool(config.get('ckan.harvest.defer_indexing', False))):
+            unit_of_work.commit()
+    except Exception, e:
+        log.exception(e)
+        from ckan.model import Session
+        Session.rollback()
+        # Let another consumer process these objects again
+        for message in messages:
+            message.requeue()
+    else:
+        for message in messages:
+            message.ack()
+        if messages:
+            log.debug('Committed a batch of %i harvest objects' % len(messages))
+
+    # Now do the work that needs the batch to be committed (e.g. indexing)
+    flush_harvesters()
+
+def consume(consumer, idle_wait=1):
+    '''
+    Processes the messages received by the consumer until interrupted,
+    like consumer.wait(), but flushing the harvesters whenever the queue
+    is empty.
+
+    If ckan.harvest.unit_of_work is enabled, the messages are processed
+    in batches of ckan.harvest.batch_size, each one committed in a single
+    transaction (see model.UnitOfWork).
+    '''
+    batched = asbool(config.get('ckan.harvest.unit_of_work', False))
+    try:
+        batch_size = int(config.get('ckan.harvest.batch_size', 100))
+    except ValueError:
+        batch_size = 100
+
+    while True:
+        if batched and not unit_of_work.active:
+            unit_of_work.begin()
+
+        message = consumer.fetch(enable_callbacks=True)
+        if message is None:
+            _end_batch()
+            time.sleep(idle_wait)
+        elif len(_pending_messages) >= batch_size:
+            _end_batch()
 
 def get_gather_consumer():
+    # Don't process anything with outdated tables
+    check_schema_version()
     consumer = get_consumer('ckan.harvest.gather','harvest_job_id')
     consumer.register_callback(gather_callback)
     log.debug('Gather queue consumer registered')
     return consumer
 
 def get_fetch_consumer():
+    # Don't process anything with outdated tables
+    check_schema_version()
     consumer = get_consumer('ckan.harvert.fetch','harvest_object_id')
     consumer.register_callback(fetch_callback)
     log.debug('Fetch queue consumer registered')
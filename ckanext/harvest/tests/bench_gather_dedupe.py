@@ -0,0 +1,49 @@
+'''
+Compares the de-duplication of the package ids found in the remote
+revisions during the incremental gather, using a list (as it used to be
+done) and using unique().
+
+This module is not collected by the test runner, run it explicitly with:
+
+    nosetests --ckan --with-pylons=test-core.ini -s ckanext/harvest/tests/bench_gather_dedupe.py
+
+The number of (revision, package) pairs and of distinct packages can be
+changed with the HARVEST_BENCH_PAIRS and HARVEST_BENCH_PACKAGES environment
+variables (defaults 100000 and 5000).
+'''
+import os
+import time
+import random
+
+from ckanext.harvest.harvesters.base import unique
+
+
+def _dedupe_with_list(package_ids):
+    result = []
+    for package_id in package_ids:
+        if not package_id in result:
+            result.append(package_id)
+    return result
+
+
+def test_gather_dedupe_benchmark():
+    pairs = int(os.environ.get('HARVEST_BENCH_PAIRS', 100000))
+    packages = int(os.environ.get('HARVEST_BENCH_PACKAGES', 5000))
+
+    random.seed(0)
+    ids = [u'%08x-1b2c-4d5e-8f90-a1b2c3d4e5f6' % i for i in range(packages)]
+    package_ids = [random.choice(ids) for i in range(pairs)]
+
+    start = time.time()
+    with_set = list(unique(package_ids))
+    set_time = time.time() - start
+
+    start = time.time()
+    with_list = _dedupe_with_list(package_ids)
+    list_time = time.time() - start
+
+    assert with_set == with_list
+
+    print '%i revision-package pairs, %i distinct packages' % (pairs, len(with_set))
+    print 'unique(): %.4f seconds' % set_time
+    print 'list:     %.4f seconds' % list_time
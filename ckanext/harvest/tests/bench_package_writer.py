@@ -0,0 +1,83 @@
+'''
+Compares the time needed to import datasets with the package actions and
+with the bulk package writer (ckan.harvest.bulk_import).
+
+This module is not collected by the test runner, run it explicitly with:
+
+    nosetests --ckan --with-pylons=test-core.ini -s ckanext/harvest/tests/bench_package_writer.py
+
+The number of datasets can be changed with the HARVEST_BENCH_COUNT
+environment variable (default 200).
+'''
+import os
+import time
+
+from pylons import config
+
+from ckan import model
+from ckan.model import Session
+
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, \
+                                  setup as harvest_model_setup
+from ckanext.harvest.harvesters.base import HarvesterBase
+
+
+def _package_dicts(prefix, count):
+    for i in range(count):
+        yield {
+            'id': u'%s-%i' % (prefix, i),
+            'name': u'%s-%i' % (prefix, i),
+            'title': u'Benchmark dataset %i' % i,
+            'notes': u'Dataset created by the package writer benchmark',
+            'tags': [u'benchmark', u'tag-%i' % (i % 10)],
+            'extras': {'source': u'benchmark', 'index': unicode(i)},
+            'resources': [
+                {'url': u'http://example.com/%s/%i.csv' % (prefix, i),
+                 'format': u'CSV', 'description': u'Data'},
+            ],
+        }
+
+
+def _import(prefix, count, bulk):
+    config['ckan.harvest.bulk_import'] = 'true' if bulk else 'false'
+
+    source = HarvestSource(url=u'http://bench-%s.com' % prefix, type=u'ckan')
+    job = HarvestJob(source=source)
+    Session.add(source)
+    Session.add(job)
+    Session.commit()
+
+    harvester = HarvesterBase()
+    harvester.config = {'user': u'harvest'}
+    harvester._package_states = None
+    start = time.time()
+    for package_dict in _package_dicts(prefix, count):
+        harvest_object = HarvestObject(guid=package_dict['id'], job=job, source=source)
+        harvest_object.save()
+        harvester._create_or_update_package(package_dict, harvest_object)
+    harvester.flush_batch()
+    elapsed = time.time() - start
+
+    created = Session.query(model.Package) \
+                     .filter(model.Package.name.like(u'%s-%%' % prefix)).count()
+    assert created == count, created
+    return elapsed
+
+
+def test_bulk_writer_benchmark():
+    harvest_model_setup()
+    count = int(os.environ.get('HARVEST_BENCH_COUNT', 200))
+    previous = config.get('ckan.harvest.bulk_import')
+    try:
+        actions = _import(u'actions', count, bulk=False)
+        bulk = _import(u'bulk', count, bulk=True)
+    finally:
+        if previous is None:
+            config.pop('ckan.harvest.bulk_import', None)
+        else:
+            config['ckan.harvest.bulk_import'] = previous
+        model.repo.rebuild_db()
+
+    print 'Imported %i datasets' % count
+    print 'Package actions: %.2f seconds (%.1f datasets/second)' % (actions, count / actions)
+    print 'Bulk writer:     %.2f seconds (%.1f datasets/second)' % (bulk, count / bulk)
@@ -0,0 +1,80 @@
+import datetime
+
+from ckan import model
+from ckan.model import Session
+from ckan.logic import get_action
+
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, \
+                                  setup as harvest_model_setup
+
+
+class TestListPagination():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        Session.add(source)
+        created = datetime.datetime(2012, 1, 1)
+        for i in range(5):
+            job = HarvestJob(source=source, created=created + datetime.timedelta(days=i))
+            Session.add(job)
+            for j in range(3):
+                Session.add(HarvestObject(guid=u'guid-%i' % j, job=job, source=source,
+                                          current=(i == 4)))
+        Session.commit()
+        self.source_id = source.id
+        Session.remove()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _context(self):
+        return {'model': model, 'session': Session, 'ignore_auth': True}
+
+    def _walk(self, action, data_dict):
+        results = []
+        pages = 0
+        while True:
+            page = get_action(action)(self._context(), data_dict)
+            results.extend(page['results'])
+            pages += 1
+            if not page['next']:
+                break
+            data_dict['after'] = page['next']
+        return results, pages
+
+    def test_job_list_without_limit_returns_a_list(self):
+        jobs = get_action('harvest_job_list')(self._context(), {})
+        assert isinstance(jobs, list)
+        assert len(jobs) == 5
+        assert [job['created'] for job in jobs] == sorted(job['created'] for job in jobs)
+
+    def test_job_list_pages(self):
+        jobs, pages = self._walk('harvest_job_list', {'limit': 2})
+        assert pages == 3
+        assert len(jobs) == 5
+        assert len(set(job['id'] for job in jobs)) == 5
+        assert [job['created'] for job in jobs] == sorted(job['created'] for job in jobs)
+
+    def test_job_list_pages_descending(self):
+        jobs, pages = self._walk('harvest_job_list', {'limit': 2, 'order': 'desc'})
+        assert len(jobs) == 5
+        assert [job['created'] for job in jobs] == sorted((job['created'] for job in jobs), reverse=True)
+
+    def test_object_list_pages(self):
+        all_ids = get_action('harvest_object_list')(self._context(),
+                {'source_id': self.source_id, 'only_current': False})
+        assert len(all_ids) == 15
+
+        object_ids, pages = self._walk('harvest_object_list',
+                {'source_id': self.source_id, 'only_current': False, 'limit': 4})
+        assert pages == 4
+        assert object_ids == sorted(all_ids)
+
+    def test_object_list_only_current(self):
+        object_ids, pages = self._walk('harvest_object_list', {'limit': 10})
+        assert pages == 1
+        assert len(object_ids) == 3
@@ -0,0 +1,507 @@
+from pylons import config
+
+from ckan import model
+from ckan.model import Session, Package
+
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, \
+                                  HarvestObjectError, unit_of_work, \
+                                  setup as harvest_model_setup
+from ckanext.harvest.harvesters.base import error_fingerprint, ErrorBuffer, \
+                                           HarvesterBase, TagMunger, munge_tag, \
+                                           get_source_config, unique
+from ckanext.harvest.indexing import IndexQueue, LocalSearchIndex
+from ckanext.harvest.tests.test_dictization import QueryCounter
+
+
+class TestErrorBuffer():
+
+    def test_fingerprint_ignores_urls_ids_and_numbers(self):
+        a = error_fingerprint('Unable to get content for URL: http://a.com/api/2/rest/package/1: HTTP Error 500')
+        b = error_fingerprint('Unable to get content for URL: http://a.com/api/2/rest/package/2: HTTP Error 500')
+        c = error_fingerprint('Invalid package with GUID 6f1d2a3e-1b2c-4d5e-8f90-a1b2c3d4e5f6: {}')
+        d = error_fingerprint('Invalid package with GUID 0a9b8c7d-6e5f-4a3b-9c1d-e2f3a4b5c6d7: {}')
+
+        assert a == b
+        assert c == d
+        assert a != c
+
+    def test_similar_errors_are_sampled_and_counted(self):
+        error_buffer = ErrorBuffer(max_samples=3)
+        for i in range(100):
+            error_buffer.add('Connection refused (%i)' % i, u'job-1', u'Fetch', u'object-%i' % i)
+        error_buffer.add('Something else', u'job-1', u'Import', u'object-0')
+        error_buffer.add('Gather failed', u'job-1', u'Gather')
+
+        assert len(error_buffer.object_errors) == 4
+        assert len(error_buffer.gather_errors) == 1
+
+        summaries = dict(((s['stage'], s['message']), s) for s in error_buffer.summaries.values())
+        fetch_summary = summaries[(u'Fetch', 'Connection refused (0)')]
+        assert fetch_summary['count'] == 100
+        assert fetch_summary['sample_object_ids'] == [u'object-0', u'object-1', u'object-2']
+        assert fetch_summary['first_seen'] <= fetch_summary['last_seen']
+        assert summaries[(u'Import', 'Something else')]['count'] == 1
+        assert summaries[(u'Gather', 'Gather failed')]['count'] == 1
+
+    def test_samples_are_per_job(self):
+        error_buffer = ErrorBuffer(max_samples=1)
+        error_buffer.add('Timeout', u'job-1', u'Fetch', u'object-1')
+        error_buffer.add('Timeout', u'job-1', u'Fetch', u'object-2')
+        error_buffer.add('Timeout', u'job-2', u'Fetch', u'object-3')
+
+        assert [e['harvest_object_id'] for e in error_buffer.object_errors] == [u'object-1', u'object-3']
+        assert len(error_buffer.summaries) == 2
+
+
+class TestTagMunger():
+
+    def test_munge_tag(self):
+        assert munge_tag(u'  Environment & Health ') == u'environment--health'
+        assert munge_tag(u'Caf\xe9') == u'cafe'
+
+    def test_results_are_cached(self):
+        munger = TagMunger()
+        assert munger(u'Some Tag') == u'some-tag'
+        assert munger(u'Some Tag') == u'some-tag'
+        assert munger(u'Other') == u'other'
+        assert munger.hits == 1
+        assert munger.misses == 2
+        assert munger.hit_rate() == 1.0 / 3
+
+    def test_least_recently_used_are_evicted(self):
+        munger = TagMunger(max_size=2)
+        munger(u'a')
+        munger(u'b')
+        munger(u'a')
+        munger(u'c')
+        assert munger.cache.keys() == [u'a', u'c']
+
+
+class TestPackageContext():
+
+    def test_schema_is_built_once_and_contexts_are_not_shared(self):
+        harvester = HarvesterBase()
+        harvester.config = {'user': u'harvest'}
+        context = harvester._get_package_context()
+        context['id'] = u'some-id'
+        other_context = harvester._get_package_context()
+
+        assert not 'id' in other_context
+        assert other_context['schema'] is context['schema']
+        assert other_context['user'] == u'harvest'
+        assert other_context['api_version'] == '2'
+
+
+class TestUnique():
+
+    def test_order_is_kept(self):
+        assert list(unique([u'b', u'a', u'b', u'c', u'a'])) == [u'b', u'a', u'c']
+
+
+class TestSourceConfig():
+
+    def test_config_is_parsed_once_per_version(self):
+        config = get_source_config(u'source-1', u'{"user": "harvest", "default_tags": ["a"]}')
+        assert config['user'] == u'harvest'
+        assert config.get('default_tags') == (u'a',)
+        assert config.source_id == u'source-1'
+
+        assert get_source_config(u'source-1', u'{"user": "harvest", "default_tags": ["a"]}') is config
+        assert not get_source_config(u'source-1', u'{"user": "other"}') is config
+        assert not get_source_config(u'source-2', u'{"user": "harvest", "default_tags": ["a"]}') is config
+
+    def test_config_is_read_only(self):
+        config = get_source_config(u'source-1', u'{"default_extras": {"a": "b"}}')
+        for modify in (lambda: config.update({'user': u'other'}),
+                       lambda: config.__setitem__('user', u'other'),
+                       lambda: config['default_extras'].pop('a')):
+            try:
+                modify()
+                assert False, 'The config was modified'
+            except TypeError:
+                pass
+
+    def test_empty_config(self):
+        config = get_source_config(u'source-1', None)
+        assert not config
+        assert config.get('api_version', '2') == '2'
+
+
+class TestCheckName():
+
+    def setup(self):
+        rev = model.repo.new_revision()
+        Session.add(Package(name=u'test'))
+        for i in range(1, 151):
+            Session.add(Package(name=u'test%i' % i))
+        Session.add(Package(name=u'other'))
+        model.repo.commit_and_remove()
+        # Harvesters are singletons, so clear the names reserved by other tests
+        HarvesterBase()._reserved_names = None
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_free_name(self):
+        assert HarvesterBase()._check_name(u'new-name') == u'new-name'
+
+    def test_no_limit_on_collisions(self):
+        assert HarvesterBase()._check_name(u'test') == u'test151'
+
+    def test_names_are_reserved_per_job(self):
+        harvester = HarvesterBase()
+        assert harvester._check_name(u'other', u'job-1') == u'other1'
+        assert harvester._check_name(u'other', u'job-1') == u'other2'
+        assert harvester._check_name(u'new-name', u'job-1') == u'new-name'
+        assert harvester._check_name(u'new-name', u'job-1') == u'new-name1'
+        assert harvester._check_name(u'new-name', u'job-2') == u'new-name'
+
+    def test_names_are_released_by_flush_batch(self):
+        harvester = HarvesterBase()
+        assert harvester._check_name(u'new-name') == u'new-name'
+        assert harvester._check_name(u'new-name') == u'new-name1'
+
+        harvester.flush_batch()
+
+        assert harvester._check_name(u'new-name') == u'new-name'
+
+
+class TestPackageStates():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        rev = model.repo.new_revision()
+        packages = [Package(name=u'dataset-%i' % i) for i in range(3)]
+        for package in packages:
+            Session.add(package)
+        model.repo.commit()
+        self.package_ids = [package.id for package in packages]
+
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        job = HarvestJob(source=source)
+        Session.add(source)
+        Session.add(job)
+        for guid in self.package_ids[:2] + [u'not-a-package']:
+            Session.add(HarvestObject(guid=guid, job=job, source=source))
+        Session.commit()
+        self.job_id = job.id
+        Session.remove()
+        HarvesterBase()._package_states = None
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_prefetch_for_job(self):
+        states = HarvesterBase().prefetch_package_states(job_id=self.job_id)
+        assert sorted(states.keys()) == sorted(self.package_ids[:2])
+        metadata_modified, state, name = states[self.package_ids[0]]
+        assert metadata_modified
+        assert state == u'active'
+        assert name == u'dataset-0'
+
+    def test_prefetch_for_ids(self):
+        states = HarvesterBase().prefetch_package_states([self.package_ids[2], u'missing'])
+        assert states.keys() == [self.package_ids[2]]
+
+    def test_get_package_state(self):
+        harvester = HarvesterBase()
+        assert harvester._get_package_state(self.package_ids[0], self.job_id)[2] == u'dataset-0'
+        # Not in the job, but loaded on demand
+        assert harvester._get_package_state(self.package_ids[2], self.job_id)[2] == u'dataset-2'
+        assert harvester._get_package_state(u'not-a-package', self.job_id) is None
+
+    def test_missing_packages_are_only_looked_up_once(self):
+        harvester = HarvesterBase()
+        harvester._get_package_state(self.package_ids[0], self.job_id)
+
+        # The guids of the job were checked by the prefetch
+        counter = QueryCounter().start()
+        assert harvester._get_package_state(u'not-a-package', self.job_id) is None
+        assert counter.stop() == 0
+
+        # Other ids are looked up once
+        counter = QueryCounter().start()
+        assert harvester._get_package_state(u'other', self.job_id) is None
+        assert harvester._get_package_state(u'other', self.job_id) is None
+        assert counter.stop() == 1
+
+
+class TestCurrentFlags():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        rev = model.repo.new_revision()
+        packages = [Package(name=u'dataset-%i' % i) for i in range(2)]
+        for package in packages:
+            Session.add(package)
+        model.repo.commit()
+        self.package_ids = [package.id for package in packages]
+
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        old_job = HarvestJob(source=source)
+        new_job = HarvestJob(source=source)
+        Session.add(source)
+        Session.add(old_job)
+        Session.add(new_job)
+        for i, package_id in enumerate(self.package_ids):
+            Session.add(HarvestObject(guid=u'remote-%i' % i, job=old_job, source=source,
+                                      package_id=package_id, current=True))
+            Session.add(HarvestObject(guid=u'remote-%i' % i, job=new_job, source=source))
+        Session.commit()
+        self.old_job_id = old_job.id
+        self.new_job_id = new_job.id
+        Session.remove()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _objects(self, job_id):
+        return Session.query(HarvestObject).filter(HarvestObject.harvest_job_id==job_id) \
+                      .order_by(HarvestObject.guid).all()
+
+    def test_flush_batch_updates_the_flags(self):
+        new_objects = self._objects(self.new_job_id)
+        harvester = HarvesterBase()
+        # Only the first package has been imported by the new job
+        harvester._pending_current = {self.package_ids[0]: new_objects[0].id}
+        Session.remove()
+
+        harvester.flush_batch()
+
+        new_objects = self._objects(self.new_job_id)
+        assert new_objects[0].package_id == self.package_ids[0]
+        assert new_objects[0].current == True
+        assert new_objects[1].package_id is None
+        assert not new_objects[1].current
+        old_objects = self._objects(self.old_job_id)
+        assert [obj.current for obj in old_objects] == [False, True]
+        assert not harvester._pending_current
+
+    def test_deferred_objects_are_only_written_by_flush_batch(self):
+        new_objects = self._objects(self.new_job_id)
+        harvester = HarvesterBase()
+        harvester._package_states = None
+        harvester._pending_current = None
+        previous = config.get('ckan.harvest.defer_current')
+        config['ckan.harvest.defer_current'] = 'true'
+        try:
+            harvester._package_written(self.package_ids[0], u'dataset-0', {},
+                                       new_objects[0])
+        finally:
+            if previous is None:
+                config.pop('ckan.harvest.defer_current', None)
+            else:
+                config['ckan.harvest.defer_current'] = previous
+
+        assert new_objects[0].package_id is None
+        assert not Session.dirty
+        assert harvester._pending_current == {self.package_ids[0]: new_objects[0].id}
+
+        harvester.flush_batch()
+        Session.remove()
+
+        new_objects = self._objects(self.new_job_id)
+        assert new_objects[0].package_id == self.package_ids[0]
+        assert new_objects[0].current == True
+
+
+class _Object(object):
+
+    def __init__(self, harvest_source_id, id=None, harvest_job_id=None):
+        self.harvest_source_id = harvest_source_id
+        self.id = id
+        self.harvest_job_id = harvest_job_id
+
+
+class TestDiscardObject():
+
+    def setup(self):
+        harvester = HarvesterBase()
+        harvester._package_states = None
+        harvester._pending_current = None
+        harvester._written_packages = None
+        harvester._bulk_packages = None
+        harvester._index_queue = IndexQueue(LocalSearchIndex())
+        unit_of_work.active = True
+
+    def teardown(self):
+        unit_of_work.active = False
+        HarvesterBase()._index_queue = None
+
+    def test_deferred_work_of_the_object_is_dropped(self):
+        harvester = HarvesterBase()
+        good = _Object(u'source', u'good', u'job')
+        bad = _Object(u'source', u'bad', u'job')
+        harvester._package_states = (u'job', {u'package-1': (None, u'active', u'dataset-1'),
+                                              u'package-2': (None, u'active', u'dataset-2')},
+                                     set())
+        harvester._written_packages = {u'good': u'package-1', u'bad': u'package-2'}
+        harvester._pending_current = {u'package-1': u'good', u'package-2': u'bad'}
+        harvester._index_queue.add(u'package-1')
+        harvester._index_queue.add(u'package-2')
+        harvester._bulk_packages = [({}, good, True, None), ({}, bad, True, None)]
+
+        assert harvester.discard_object(bad) == u'package-2'
+
+        assert harvester._pending_current == {u'package-1': u'good'}
+        assert harvester._index_queue.pending == [u'package-1']
+        assert [item[1] for item in harvester._bulk_packages] == [good]
+        assert harvester._package_states[1].keys() == [u'package-1']
+        assert harvester.discard_object(_Object(u'source', u'other')) is None
+
+
+class TestWritePackages():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        Session.add(model.User(name=u'harvest'))
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        job = HarvestJob(source=source)
+        Session.add(source)
+        Session.add(job)
+        for i in range(2):
+            Session.add(HarvestObject(guid=u'remote-%i' % i, job=job, source=source))
+        Session.commit()
+        self.job_id = job.id
+        Session.remove()
+
+        harvester = HarvesterBase()
+        harvester._package_states = None
+        harvester._pending_current = None
+        harvester._written_packages = None
+        harvester._error_buffer = None
+
+    def teardown(self):
+        unit_of_work.active = False
+        model.repo.rebuild_db()
+
+    def _write_conflicting_batch(self):
+        objects = Session.query(HarvestObject).order_by(HarvestObject.guid).all()
+        config = {'user': u'harvest'}
+        # Both packages are valid on their own, but have the same name
+        harvester = HarvesterBase()
+        harvester._bulk_packages = [
+            ({'id': u'remote-%i' % i, 'name': u'same-name', 'title': u'Dataset %i' % i},
+             obj, True, config)
+            for i, obj in enumerate(objects)]
+        object_ids = [obj.id for obj in objects]
+
+        harvester.write_packages()
+        harvester.flush_batch()
+        return object_ids
+
+    def test_conflicting_batch_is_written_with_the_actions(self):
+        object_ids = self._write_conflicting_batch()
+        Session.remove()
+
+        self._check_conflicting_batch(object_ids)
+
+    def test_failed_package_does_not_break_the_unit_of_work(self):
+        unit_of_work.begin()
+        object_ids = self._write_conflicting_batch()
+        unit_of_work.commit()
+        Session.remove()
+
+        self._check_conflicting_batch(object_ids)
+
+    def _check_conflicting_batch(self, object_ids):
+        package = Package.by_name(u'same-name')
+        assert package.id == u'remote-0'
+        assert Package.get(u'remote-1') is None
+        errors = Session.query(HarvestObjectError).all()
+        assert [error.harvest_object_id for error in errors] == [object_ids[1]], errors
+        assert HarvestObject.get(object_ids[0]).package_id == u'remote-0'
+        assert HarvestObject.get(object_ids[0]).current == True
+
+
+class TestWatermarks():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        source.save()
+        self.source_id = source.id
+        Session.remove()
+        HarvesterBase()._pending_watermarks = None
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_watermark_only_moves_forward(self):
+        harvester = HarvesterBase()
+        obj = _Object(self.source_id)
+        harvester._advance_watermark(obj, u'2012-03-01T10:00:00.000001')
+        harvester._advance_watermark(obj, u'2012-05-01T10:00:00')
+        harvester._advance_watermark(obj, u'2012-04-01T10:00:00')
+        harvester._advance_watermark(obj, None)
+        harvester.flush_batch()
+        assert HarvestSource.get(self.source_id).watermark == u'2012-05-01T10:00:00'
+
+        harvester._advance_watermark(obj, u'2012-01-01T10:00:00')
+        harvester.flush_batch()
+        assert HarvestSource.get(self.source_id).watermark == u'2012-05-01T10:00:00'
+
+
+class TestDeleteMissingPackages():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        rev = model.repo.new_revision()
+        packages = [Package(name=u'dataset-%i' % i) for i in range(3)]
+        for package in packages:
+            Session.add(package)
+        model.repo.commit()
+        self.package_ids = [package.id for package in packages]
+
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        job = HarvestJob(source=source)
+        Session.add(source)
+        Session.add(job)
+        for i, package_id in enumerate(self.package_ids):
+            Session.add(HarvestObject(guid=u'remote-%i' % i, job=job, source=source,
+                                      package_id=package_id, current=True))
+        Session.commit()
+        self.job_id = job.id
+        Session.remove()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_missing_packages_are_deleted(self):
+        job = HarvestJob.get(self.job_id)
+        deleted = HarvesterBase()._delete_missing_packages(job, set([u'remote-1', u'other']), 2)
+
+        assert deleted == 2
+        assert HarvestJob.get(self.job_id).deleted_count == 2
+        states = [Package.get(package_id).state for package_id in self.package_ids]
+        assert states == [u'deleted', u'active', u'deleted'], states
+        current = Session.query(HarvestObject).filter(HarvestObject.current==True).all()
+        assert [obj.guid for obj in current] == [u'remote-1']
+
+    def test_nothing_is_deleted_without_remote_ids(self):
+        job = HarvestJob.get(self.job_id)
+        assert HarvesterBase()._delete_missing_packages(job, set(), 0) == 0
+        assert Package.get(self.package_ids[0]).state == u'active'
+
+    def test_nothing_is_deleted_from_an_incomplete_listing(self):
+        job = HarvestJob.get(self.job_id)
+        deleted = HarvesterBase()._delete_missing_packages(job, set([u'remote-1']), 3)
+
+        assert deleted == 0
+        states = [Package.get(package_id).state for package_id in self.package_ids]
+        assert states == [u'active'] * 3, states
@@ -0,0 +1,401 @@
+import time
+import urllib
+import datetime
+
+from pylons import config
+
+from ckan import model
+from ckan.model import Session, Package
+from ckan.lib.helpers import json
+
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, \
+                                  HarvestGatherError, setup as harvest_model_setup
+from ckanext.harvest.harvesters.ckanharvester import CKANHarvester
+
+
+class _SlowHarvester(CKANHarvester):
+
+    def _get_content(self, url, config=None):
+        time.sleep(0.1)
+        if url.endswith('error'):
+            raise Exception('Server error')
+        return 'content for %s' % url
+
+
+class TestGetContents():
+
+    def test_urls_are_requested_concurrently(self):
+        previous = config.get('ckan.harvest.http_workers')
+        config['ckan.harvest.http_workers'] = '5'
+        urls = ['http://remote/revision/%i' % i for i in range(9)] + ['http://remote/error']
+
+        try:
+            start = time.time()
+            results = list(_SlowHarvester()._get_contents(urls))
+            elapsed = time.time() - start
+        finally:
+            if previous is None:
+                config.pop('ckan.harvest.http_workers', None)
+            else:
+                config['ckan.harvest.http_workers'] = previous
+
+        assert [url for url, content, error in results] == urls
+        for url, content, error in results[:-1]:
+            assert content == 'content for %s' % url
+            assert error is None
+        url, content, error = results[-1]
+        assert content is None
+        assert str(error) == 'Server error'
+        assert elapsed < 0.5, elapsed
+
+
+class TestSearchResults():
+
+    def test_search_result_to_package_dict(self):
+        result = {
+            'id': u'remote-id',
+            'name': u'remote-name',
+            'tags': [{'name': u'tag-1'}, u'tag-2'],
+            'extras': [{'key': u'a', 'value': u'1'}],
+            'groups': [u'group-id'],
+            'index_id': u'abc',
+            'indexed_ts': u'2012-01-01T00:00:00Z',
+        }
+        package_dict = CKANHarvester()._search_result_to_package_dict(result)
+
+        assert package_dict['id'] == u'remote-id'
+        assert package_dict['tags'] == [u'tag-1', u'tag-2']
+        assert package_dict['extras'] == {u'a': u'1'}
+        assert package_dict['groups'] == [u'group-id']
+        assert not 'index_id' in package_dict
+        assert not 'indexed_ts' in package_dict
+
+
+class TestReadOnlyRoles():
+
+    def setup(self):
+        rev = model.repo.new_revision()
+        creator = model.User(name=u'creator')
+        Session.add(creator)
+        Session.add(model.User(name=u'harvest'))
+        packages = [Package(name=u'dataset-%i' % i) for i in range(2)]
+        for package in packages:
+            Session.add(package)
+            Session.add(model.PackageRole(package=package, user=creator, role=model.Role.ADMIN))
+        model.repo.commit_and_remove()
+        self.package_ids = [package.id for package in packages]
+
+        harvester = CKANHarvester()
+        harvester._pending_read_only = None
+        harvester._user_ids = None
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _roles(self, package_id):
+        return sorted((role.user.name, role.role) for role in
+                      Session.query(model.PackageRole).filter_by(package_id=package_id)
+                      if role.user)
+
+    def test_roles_are_set_in_batch(self):
+        harvester = CKANHarvester()
+        harvester._pending_read_only = {u'harvest': self.package_ids + self.package_ids[:1]}
+        harvester._set_read_only_roles()
+
+        for package_id in self.package_ids:
+            roles = self._roles(package_id)
+            assert (u'harvest', model.Role.ADMIN) in roles, roles
+            assert not u'creator' in [name for name, role in roles], roles
+            assert [role for name, role in roles if name != u'harvest'] == \
+                   [model.Role.READER] * (len(roles) - 1), roles
+        assert not harvester._pending_read_only
+
+
+class _Interrupted(BaseException):
+    pass
+
+
+class _SearchHarvester(CKANHarvester):
+    '''
+    Harvester for a remote site with 5 packages, which returns up to
+    page_size of them per page of search results. Only the first total
+    packages are returned, and count is the number of packages reported.
+    '''
+
+    def _get_content(self, url, config=None):
+        offset = int(url.split('offset=')[1].split('&')[0])
+        if offset == self.interrupt_at:
+            raise _Interrupted()
+        self.offsets.append(offset)
+        self.urls.append(url)
+        results = [{'id': u'remote-%i' % i, 'name': u'dataset-%i' % i}
+                   for i in range(offset, min(offset + self.page_size, self.total))]
+        return json.dumps({'count': self.count, 'results': results})
+
+
+class TestGatherWithSearch():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        job = HarvestJob(source=source)
+        Session.add(source)
+        Session.add(job)
+        Session.commit()
+        self.job_id = job.id
+        self.config = {'search_gather': True, 'search_rows': 2}
+
+        harvester = _SearchHarvester()
+        harvester.interrupt_at = None
+        harvester.page_size = 2
+        harvester.total = 5
+        harvester.count = 5
+        harvester.offsets = []
+        harvester.urls = []
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_interrupted_gather_is_resumed(self):
+        harvester = _SearchHarvester()
+        harvester.interrupt_at = 4
+        try:
+            harvester._gather_with_search('http://remote/api/search', HarvestJob.get(self.job_id),
+                                          self.config)
+        except _Interrupted:
+            pass
+        Session.remove()
+
+        job = HarvestJob.get(self.job_id)
+        assert job.gather_checkpoint == u'4'
+        assert job.gather_object_count == 4
+
+        harvester.interrupt_at = None
+        harvester.offsets = []
+        object_ids = harvester._gather_with_search('http://remote/api/search', job, self.config)
+
+        assert harvester.offsets == [4], harvester.offsets
+        guids = sorted(guid for (guid,) in Session.query(HarvestObject.guid))
+        assert guids == [u'remote-%i' % i for i in range(5)], guids
+        assert len(object_ids) == 5
+
+    def test_paging_continues_when_the_remote_returns_fewer_rows(self):
+        harvester = _SearchHarvester()
+        self.config['search_rows'] = 3
+        object_ids = harvester._gather_with_search('http://remote/api/search',
+                                                   HarvestJob.get(self.job_id), self.config)
+
+        assert harvester.offsets == [0, 2, 4], harvester.offsets
+        assert len(object_ids) == 5
+
+    def test_version_1_guids_are_package_names(self):
+        harvester = _SearchHarvester()
+        self.config['api_version'] = '1'
+        harvester._gather_with_search('http://remote/api/1/search',
+                                      HarvestJob.get(self.job_id), self.config)
+
+        guids = sorted(guid for (guid,) in Session.query(HarvestObject.guid))
+        assert guids == [u'dataset-%i' % i for i in range(5)], guids
+
+    def test_watermark_is_used_after_a_harvest_without_changes(self):
+        job = HarvestJob.get(self.job_id)
+        job.source.watermark = u'2012-06-01T10:00:00.123456'
+        previous_job = HarvestJob(source=job.source, status=u'Finished',
+                                  gather_started=datetime.datetime(2012, 6, 2),
+                                  gather_finished=datetime.datetime(2012, 6, 2))
+        Session.add(previous_job)
+        Session.commit()
+
+        harvester = _SearchHarvester()
+        object_ids = harvester.gather_stage(job)
+
+        assert len(object_ids) == 5
+        assert 'metadata_modified' in urllib.unquote(harvester.urls[0]), harvester.urls
+
+    def test_search_rows_is_capped(self):
+        config = json.dumps({'search_rows': CKANHarvester.max_search_rows + 1})
+        try:
+            CKANHarvester().validate_config(config)
+        except ValueError:
+            pass
+        else:
+            assert False, 'search_rows is not capped'
+
+
+class TestDeleteMissingWithSearch():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        rev = model.repo.new_revision()
+        packages = [Package(name=u'dataset-%i' % i) for i in range(5)]
+        for package in packages:
+            Session.add(package)
+        model.repo.commit()
+        self.package_ids = [package.id for package in packages]
+
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        previous_job = HarvestJob(source=source)
+        job = HarvestJob(source=source)
+        Session.add(source)
+        Session.add(previous_job)
+        Session.add(job)
+        for i, package_id in enumerate(self.package_ids):
+            Session.add(HarvestObject(guid=u'remote-%i' % i, job=previous_job, source=source,
+                                      package_id=package_id, current=True))
+        Session.commit()
+        self.job_id = job.id
+        self.config = {'search_rows': 2, 'delete_missing': True}
+
+        harvester = _SearchHarvester()
+        harvester.interrupt_at = None
+        harvester.page_size = 2
+        harvester.total = 5
+        harvester.count = 5
+        harvester.offsets = []
+        harvester.urls = []
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _states(self):
+        return [Package.get(package_id).state for package_id in self.package_ids]
+
+    def test_incomplete_listing_deletes_nothing(self):
+        harvester = _SearchHarvester()
+        harvester.total = 3
+        harvester._gather_with_search('http://remote/api/search',
+                                      HarvestJob.get(self.job_id), self.config)
+
+        assert harvester.offsets == [0, 2, 3], harvester.offsets
+        assert self._states() == [u'active'] * 5, self._states()
+        assert not HarvestJob.get(self.job_id).deleted_count
+
+    def test_complete_listing_deletes_missing_packages(self):
+        harvester = _SearchHarvester()
+        harvester.total = harvester.count = 4
+        harvester._gather_with_search('http://remote/api/search',
+                                      HarvestJob.get(self.job_id), self.config)
+
+        assert self._states() == [u'active'] * 4 + [u'deleted'], self._states()
+        assert HarvestJob.get(self.job_id).deleted_count == 1
+
+    def test_packages_are_not_deleted_with_api_version_1(self):
+        harvester = _SearchHarvester()
+        harvester.total = harvester.count = 4
+        config = dict(self.config, api_version=1)
+        harvester._gather_with_search('http://remote/api/search',
+                                      HarvestJob.get(self.job_id), config)
+
+        assert self._states() == [u'active'] * 5, self._states()
+
+
+class _BrokenListingHarvester(CKANHarvester):
+
+    def _get_json_array(self, url, config=None):
+        yield u'remote-0'
+        yield u'remote-1'
+        raise ValueError('Unexpected end of JSON array')
+
+
+class TestBrokenListing():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_objects_created_before_the_error_are_returned(self):
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        job = HarvestJob(source=source)
+        Session.add(source)
+        Session.add(job)
+        Session.commit()
+
+        harvester = _BrokenListingHarvester()
+        object_ids = harvester.gather_stage(job)
+        harvester.flush_batch()
+
+        guids = sorted(guid for (guid,) in Session.query(HarvestObject.guid))
+        assert guids == [u'remote-0', u'remote-1'], guids
+        assert len(object_ids) == 2
+        messages = [error.message for error in Session.query(HarvestGatherError)]
+        assert len(messages) == 1, messages
+        assert 'http://test-source.com/api/2/rest/package' in messages[0], messages
+
+
+class _ConditionalHarvester(CKANHarvester):
+
+    def _get_response(self, url, headers=None, config=None):
+        self.requests.append((url, headers))
+        return self.response
+
+
+class TestConditionalFetch():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        previous_job = HarvestJob(source=source)
+        job = HarvestJob(source=source)
+        Session.add(source)
+        Session.add(previous_job)
+        Session.add(job)
+        # The current object has the validators of the last response
+        Session.add(HarvestObject(guid=u'remote-0', job=previous_job, source=source,
+                                  current=True, content=u'{"id": "remote-0"}',
+                                  etag=u'"abc"', last_modified=u'Fri, 01 Jun 2012 10:00:00 GMT'))
+        # An older one that is not current anymore
+        Session.add(HarvestObject(guid=u'remote-0', job=previous_job, source=source,
+                                  current=False, content=u'old', etag=u'"old"'))
+        obj = HarvestObject(guid=u'remote-0', job=job, source=source)
+        Session.add(obj)
+        Session.commit()
+        self.object_id = obj.id
+        Session.remove()
+
+        harvester = _ConditionalHarvester()
+        harvester.requests = []
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_not_modified_package_is_not_imported(self):
+        harvester = _ConditionalHarvester()
+        harvester.response = (304, {}, '')
+
+        result = harvester.fetch_stage(HarvestObject.get(self.object_id))
+
+        assert result is False
+        url, headers = harvester.requests[0]
+        assert url == 'http://test-source.com/api/2/rest/package/remote-0'
+        assert headers == {'If-None-Match': u'"abc"',
+                           'If-Modified-Since': u'Fri, 01 Jun 2012 10:00:00 GMT'}, headers
+        Session.remove()
+        obj = HarvestObject.get(self.object_id)
+        assert obj.content == u'{"id": "remote-0"}'
+        assert obj.etag == u'"abc"'
+        assert obj.last_modified == u'Fri, 01 Jun 2012 10:00:00 GMT'
+
+    def test_modified_package_is_stored(self):
+        harvester = _ConditionalHarvester()
+        harvester.response = (200, {'etag': '"def"'}, '{"id": "remote-0", "title": "New"}')
+
+        result = harvester.fetch_stage(HarvestObject.get(self.object_id))
+
+        assert result is True
+        Session.remove()
+        obj = HarvestObject.get(self.object_id)
+        assert obj.content == u'{"id": "remote-0", "title": "New"}'
+        assert obj.etag == u'"def"'
+        assert obj.last_modified is None
@@ -0,0 +1,262 @@
+import logging
+
+from sqlalchemy import event
+
+from ckan import model
+from ckan.model import Session, Package
+from ckan.model.meta import engine
+from ckan.logic import get_action
+
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, \
+                                  HarvestGatherError, HarvestObjectError, \
+                                  setup as harvest_model_setup
+
+log = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    '''
+    Counts the SQL statements sent to the database between start() and
+    stop().
+    '''
+    active = None
+
+    def __init__(self):
+        self.count = 0
+
+    def start(self):
+        self.count = 0
+        QueryCounter.active = self
+        return self
+
+    def stop(self):
+        QueryCounter.active = None
+        return self.count
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if QueryCounter.active:
+        QueryCounter.active.count += 1
+
+event.listen(engine, 'before_cursor_execute', _count_query)
+
+
+class TestDictizationQueries():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _create_job(self, num_objects):
+        source = HarvestSource(url=u'http://test-source.com',type=u'ckan')
+        Session.add(source)
+        job = HarvestJob(source=source)
+        Session.add(job)
+        for i in range(num_objects):
+            obj = HarvestObject(guid=u'guid-%i' % i, job=job, source=source)
+            Session.add(obj)
+            Session.add(HarvestObjectError(message=u'Error %i' % i, object=obj, stage=u'Fetch'))
+        Session.add(HarvestGatherError(message=u'Gather error', job=job))
+        Session.commit()
+        job_id = job.id
+        Session.remove()
+        return job_id
+
+    def _context(self):
+        return {'model': model, 'session': Session, 'ignore_auth': True}
+
+    def _count_job_show(self, job_id):
+        counter = QueryCounter().start()
+        job = get_action('harvest_job_show')(self._context(), {'id': job_id})
+        count = counter.stop()
+        Session.remove()
+        return job, count
+
+    def test_job_show_query_count_does_not_grow_with_objects(self):
+        small_job_id = self._create_job(2)
+        big_job_id = self._create_job(20)
+
+        small_job, small_count = self._count_job_show(small_job_id)
+        big_job, big_count = self._count_job_show(big_job_id)
+
+        assert len(small_job['objects']) == 2
+        assert len(big_job['objects']) == 20
+        assert len(big_job['gather_errors']) == 1
+        assert big_count == small_count, (small_count, big_count)
+
+    def test_job_list_query_count_does_not_grow_with_jobs(self):
+        self._create_job(2)
+
+        counter = QueryCounter().start()
+        jobs = get_action('harvest_job_list')(self._context(), {})
+        single_count = counter.stop()
+        Session.remove()
+        assert len(jobs) == 1
+
+        for i in range(5):
+            self._create_job(3)
+
+        counter = QueryCounter().start()
+        jobs = get_action('harvest_job_list')(self._context(), {})
+        many_count = counter.stop()
+        assert len(jobs) == 6
+
+        assert many_count == single_count, (single_count, many_count)
+
+    def test_job_list_summary(self):
+        self._create_job(3)
+        self._create_job(0)
+        context = self._context()
+        context['summary'] = True
+
+        counter = QueryCounter().start()
+        jobs = get_action('harvest_job_list')(context, {})
+        count = counter.stop()
+
+        assert sorted(job['object_count'] for job in jobs) == [0, 3]
+        for job in jobs:
+            assert not 'objects' in job
+            assert job['fetched_count'] == 0
+            assert job['imported_count'] == 0
+            assert len(job['gather_errors']) == 1
+        # The jobs, their gather errors and the object counts
+        assert count == 3, count
+
+    def test_object_show_does_not_load_package(self):
+        job_id = self._create_job(1)
+        obj = Session.query(HarvestObject).filter(HarvestObject.harvest_job_id==job_id).one()
+        obj_id = obj.id
+        Session.remove()
+
+        counter = QueryCounter().start()
+        obj = get_action('harvest_object_show')(self._context(), {'id': obj_id})
+        count = counter.stop()
+
+        assert len(obj['errors']) == 1
+        # One query for the object and one for its errors
+        assert count == 2, count
+
+
+class TestSourceStatusQueries():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _harvest(self, num_added, num_updated):
+        '''
+        Creates a source with two finished jobs, the first one importing
+        num_updated packages and the second one importing them again and
+        num_added new ones. Returns the source id.
+        '''
+        rev = model.repo.new_revision()
+        packages = [Package(name=u'dataset-%i-%i' % (num_added, i))
+                    for i in range(num_added + num_updated)]
+        for package in packages:
+            Session.add(package)
+        model.repo.commit()
+
+        source = HarvestSource(url=u'http://test-source-%i.com' % num_added, type=u'ckan')
+        Session.add(source)
+        first_job = HarvestJob(source=source, status=u'Finished')
+        Session.add(first_job)
+        Session.commit()
+        last_job = HarvestJob(source=source, status=u'Finished')
+        Session.add(last_job)
+        for package in packages[:num_updated]:
+            Session.add(HarvestObject(guid=package.name, job=first_job, source=source,
+                                      package_id=package.id))
+        for package in packages:
+            Session.add(HarvestObject(guid=package.name, job=last_job, source=source,
+                                      package_id=package.id, current=True))
+        # Objects that failed to import are not counted
+        Session.add(HarvestObject(guid=u'failed', job=last_job, source=source))
+        Session.commit()
+        source_id = source.id
+        Session.remove()
+        return source_id
+
+    def _count_source_show(self, source_id):
+        context = {'model': model, 'session': Session, 'ignore_auth': True}
+        counter = QueryCounter().start()
+        source = get_action('harvest_source_show')(context, {'id': source_id})
+        count = counter.stop()
+        Session.remove()
+        return source['status']['last_harvest_statistics'], count
+
+    def test_added_and_updated_are_counted_in_one_query(self):
+        small_id = self._harvest(1, 1)
+        small_stats, small_count = self._count_source_show(small_id)
+        big_id = self._harvest(10, 5)
+        big_stats, big_count = self._count_source_show(big_id)
+
+        assert (small_stats['added'], small_stats['updated']) == (1, 1), small_stats
+        assert (big_stats['added'], big_stats['updated']) == (10, 5), big_stats
+        assert big_count == small_count, (small_count, big_count)
+
+
+class TestSourceListQueries():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        Session.add(model.User(name=u'testsysadmin'))
+        Session.commit()
+        sysadmin = model.User.by_name(u'testsysadmin')
+        model.add_user_to_role(sysadmin, model.Role.ADMIN, model.System())
+        model.repo.commit_and_remove()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _create_source(self, i):
+        rev = model.repo.new_revision()
+        package = Package(name=u'dataset-%i' % i)
+        Session.add(package)
+        model.repo.commit()
+
+        source = HarvestSource(url=u'http://test-source-%i.com' % i, type=u'ckan')
+        Session.add(source)
+        job = HarvestJob(source=source, status=u'Finished')
+        Session.add(job)
+        Session.add(HarvestJob(source=source))
+        obj = HarvestObject(guid=u'guid', job=job, source=source,
+                            package_id=package.id, current=True)
+        Session.add(obj)
+        Session.add(HarvestObjectError(message=u'Error', object=obj, stage=u'Fetch'))
+        Session.add(HarvestGatherError(message=u'Gather error', job=job))
+        Session.commit()
+        Session.remove()
+
+    def _count_source_list(self):
+        context = {'model': model, 'session': Session, 'user': u'testsysadmin'}
+        counter = QueryCounter().start()
+        sources = get_action('harvest_source_list')(context, {})
+        count = counter.stop()
+        Session.remove()
+        return sources, count
+
+    def test_source_list_query_count_does_not_grow_with_sources(self):
+        self._create_source(0)
+        sources, single_count = self._count_source_list()
+        assert len(sources) == 1
+
+        for i in range(1, 5):
+            self._create_source(i)
+        sources, many_count = self._count_source_list()
+        assert len(sources) == 5
+
+        for source in sources:
+            status = source['status']
+            assert status['job_count'] == 2
+            assert status['next_harvest'] == 'Scheduled'
+            assert status['last_harvest_statistics']['errors'] == 2
+            assert status['overall_statistics'] == {'added': 1, 'errors': 2}
+        assert many_count == single_count, (single_count, many_count)
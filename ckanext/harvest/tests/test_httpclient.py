@@ -0,0 +1,223 @@
+import gzip
+import socket
+import shutil
+import tempfile
+import threading
+import urllib2
+import json
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+from ckanext.harvest.harvesters.httpclient import HTTPClient, ResponseCache, \
+                                                iter_json_array
+
+
+_GZIP_BODY = ','.join(str(i) for i in range(5000))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/target')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.path == '/gzip':
+            body = _GZIP_BODY
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                buf = StringIO()
+                f = gzip.GzipFile(fileobj=buf, mode='wb')
+                f.write(body)
+                f.close()
+                body = buf.getvalue()
+                self.send_response(200)
+                self.send_header('Content-Encoding', 'gzip')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', '7')
+            self.end_headers()
+            self.wfile.write('version')
+            return
+
+        status = 404 if self.path == '/missing' else 200
+        body = 'path:%s auth:%s' % (self.path, self.headers.get('Authorization'))
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestHTTPClient():
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = _Server(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.base_url = 'http://127.0.0.1:%i' % cls.server.server_address[1]
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+
+    def test_connections_are_reused(self):
+        client = HTTPClient(proxies={})
+        for i in range(5):
+            content = client.get(self.base_url + '/package/%i?a=b' % i, {'Authorization': 'key'})
+            assert content == 'path:/package/%i?a=b auth:key' % i, content
+
+        stats = client.stats()
+        assert stats['requests'] == 5
+        assert stats['connections_opened'] == 1
+        assert stats['connections_reused'] == 4
+        client.close()
+
+    def test_redirects_are_followed(self):
+        client = HTTPClient()
+        assert client.get(self.base_url + '/redirect').startswith('path:/target ')
+
+    def test_errors_raise_http_error(self):
+        client = HTTPClient()
+        try:
+            client.get(self.base_url + '/missing')
+            assert False, 'HTTPError not raised'
+        except urllib2.HTTPError, e:
+            assert e.getcode() == 404
+
+    def test_conditional_requests(self):
+        client = HTTPClient()
+        status, headers, body = client.get_response(self.base_url + '/etag')
+        assert status == 200
+        assert headers['etag'] == '"v1"'
+        assert body == 'version'
+
+        status, headers, body = client.get_response(self.base_url + '/etag',
+                                                    {'If-None-Match': headers['etag']})
+        assert status == 304
+        assert body == ''
+
+    def test_responses_are_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            client = HTTPClient(cache=ResponseCache(cache_dir))
+            first = client.get(self.base_url + '/cached')
+            second = client.get(self.base_url + '/cached')
+            assert first == second
+            assert client.stats()['requests'] == 1
+            assert client.stats()['cached'] == 1
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_stale_connections_are_not_retried(self):
+        client = HTTPClient(proxies={})
+        url = self.base_url + '/package'
+        key = client._get_key(url)
+        # Two idle connections, both closed since they were used
+        for i in range(2):
+            connection = client._new_connection(key)
+            connection.connect()
+            connection.sock.shutdown(socket.SHUT_RDWR)
+            client._release_connection(key, connection)
+
+        assert client.get(url).startswith('path:/package ')
+        stats = client.stats()
+        assert stats['connections_reused'] == 1
+        assert stats['connections_opened'] == 3
+        assert client._get_pool(key).qsize() == 1
+        client.close()
+
+    def test_proxy(self):
+        client = HTTPClient(proxies={'http': self.base_url.replace('127.0.0.1', 'user:pass@127.0.0.1')})
+        content = client.get('http://remote.example.com/package?a=b')
+        assert content == 'path:http://remote.example.com/package?a=b auth:None', content
+
+        proxy_host, proxy_port, proxy_auth = client._get_key('http://remote.example.com')[3]
+        assert proxy_port == self.server.server_address[1]
+        assert proxy_auth == 'Basic dXNlcjpwYXNz'
+
+    def test_gzip(self):
+        client = HTTPClient()
+        assert client.get(self.base_url + '/gzip') == _GZIP_BODY
+
+    def test_stream(self):
+        client = HTTPClient()
+        chunks = list(client.stream(self.base_url + '/gzip', chunk_size=100))
+        assert len(chunks) > 1
+        assert ''.join(chunks) == _GZIP_BODY
+
+        # The connection is reused once the response has been read
+        assert client.get(self.base_url + '/other').startswith('path:/other ')
+        assert client.stats()['connections_opened'] == 1
+
+
+class TestIterJSONArray():
+
+    def _chunks(self, text, size):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_items_split_across_chunks(self):
+        data = [u'6f1d2a3e-1b2c', u'caf\xe9', 12345, 1.5, {'a': [1, 2]}, None, True]
+        text = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        for size in (1, 2, 3, 10, len(text)):
+            assert list(iter_json_array(self._chunks(text, size))) == data
+
+    def test_empty_array(self):
+        assert list(iter_json_array([' [', ' ] '])) == []
+
+    def test_invalid_arrays(self):
+        for chunks in (['{}'], ['[1,'], ['[1 2]'], ['["a"']):
+            try:
+                list(iter_json_array(chunks))
+                assert False, 'ValueError not raised for %r' % chunks
+            except ValueError:
+                pass
+
+
+class TestResponseCache():
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_oldest_responses_are_evicted(self):
+        cache = ResponseCache(self.cache_dir, max_size=25)
+        cache.set('http://remote/1', 'a' * 10)
+        cache.set('http://remote/2', 'b' * 10)
+        assert cache.get('http://remote/1') == 'a' * 10
+        assert cache.get('http://remote/3') is None
+
+        cache.set('http://remote/3', 'c' * 10)
+        assert cache.size <= 25
+        assert cache.get('http://remote/3') == 'c' * 10
+        assert cache.get('http://remote/1') is None
+
+        # The size is worked out again when reopening the cache
+        assert ResponseCache(self.cache_dir, max_size=25).size == cache.size
@@ -0,0 +1,147 @@
+import threading
+
+from ckanext.harvest import indexing
+from ckanext.harvest.indexing import IndexQueue, LocalSearchIndex, SearchIndex, \
+                                     synchronous_indexing_suspended
+
+
+class TestIndexQueue():
+
+    def setup(self):
+        self.packages = {
+            u'a': {'id': u'a', 'name': u'dataset-a', 'state': u'active'},
+            u'b': {'id': u'b', 'name': u'dataset-b', 'state': u'active'},
+            u'c': {'id': u'c', 'name': u'dataset-c', 'state': u'deleted'},
+        }
+        self.index = LocalSearchIndex()
+        self.loads = []
+        self.queue = IndexQueue(self.index, batch_size=2, load_packages=self._load_packages)
+
+    def _load_packages(self, package_ids):
+        self.loads.append(list(package_ids))
+        return dict((package_id, self.packages[package_id])
+                    for package_id in package_ids if package_id in self.packages)
+
+    def test_nothing_is_indexed_until_flushed(self):
+        self.queue.add(u'a')
+        self.queue.add(u'b')
+        assert self.queue.is_full()
+        assert self.index.packages == {}
+        assert self.index.commits == 0
+
+    def test_flush_indexes_and_commits_once(self):
+        self.queue.add(u'a')
+        self.queue.add(u'b')
+        self.queue.add(u'a')
+        assert len(self.queue) == 2
+
+        self.queue.flush()
+
+        assert sorted(self.index.packages.keys()) == [u'a', u'b']
+        assert self.index.commits == 1
+        assert self.loads == [[u'a', u'b']]
+        assert self.queue.indexed == 2
+        assert self.queue.index_time >= 0
+        assert len(self.queue) == 0
+
+    def test_deleted_and_missing_packages(self):
+        self.index.packages[u'c'] = self.packages[u'c']
+        self.queue.add(u'c')
+        self.queue.add(u'missing')
+
+        self.queue.flush()
+
+        assert self.index.packages == {}
+        assert self.index.commits == 1
+
+
+class _Index(object):
+
+    def __init__(self):
+        self.calls = []
+        self.commits = 0
+
+    def index_package(self, package_dict, defer_commit=False):
+        self.calls.append(defer_commit)
+        if package_dict.get('broken'):
+            raise TypeError('Error while indexing')
+
+    def commit(self):
+        self.commits += 1
+
+
+class _OldIndex(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def index_package(self, package_dict):
+        self.calls += 1
+
+
+class TestSearchIndex():
+
+    def test_commit_is_deferred(self):
+        index = _Index()
+        search_index = SearchIndex(index)
+        search_index.index_package({'id': u'a'})
+        search_index.commit()
+
+        assert search_index.defer_commit
+        assert index.calls == [True]
+        assert index.commits == 1
+
+    def test_errors_while_indexing_are_not_retried(self):
+        index = _Index()
+        try:
+            SearchIndex(index).index_package({'id': u'a', 'broken': True})
+        except TypeError:
+            pass
+        else:
+            assert False, 'The error was not raised'
+        assert index.calls == [True]
+
+    def test_old_index_commits_every_package(self):
+        index = _OldIndex()
+        search_index = SearchIndex(index)
+        search_index.index_package({'id': u'a'})
+        search_index.commit()
+
+        assert not search_index.defer_commit
+        assert index.calls == 1
+
+
+class _SynchronousSearchPlugin(object):
+
+    def __init__(self):
+        self.notified = []
+
+    def notify(self, entity, operation):
+        self.notified.append(entity)
+
+
+class TestSynchronousIndexingSuspended():
+
+    def setup(self):
+        self.plugin = _SynchronousSearchPlugin()
+        self._get_plugin = indexing._get_synchronous_search_plugin
+        indexing._get_synchronous_search_plugin = lambda: self.plugin
+
+    def teardown(self):
+        indexing._get_synchronous_search_plugin = self._get_plugin
+
+    def test_only_the_current_thread_is_suspended(self):
+        with synchronous_indexing_suspended():
+            self.plugin.notify(u'harvested', 'new')
+            other = threading.Thread(target=self.plugin.notify, args=(u'edited', 'changed'))
+            other.start()
+            other.join()
+        self.plugin.notify(u'after', 'new')
+
+        assert self.plugin.notified == [u'edited', u'after']
+
+    def test_not_suspended_unless_requested(self):
+        with synchronous_indexing_suspended(False):
+            self.plugin.notify(u'harvested', 'new')
+
+        assert self.plugin.notified == [u'harvested']
@@ -0,0 +1,43 @@
+from ckan.model import Session
+
+from ckanext.harvest import model as harvest_model
+from ckanext.harvest.model import SCHEMA_VERSION, HarvestError, get_schema_version, \
+                                  check_schema_version, migrate, \
+                                  setup as harvest_model_setup
+
+
+class TestSchemaVersion():
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def teardown(self):
+        harvest_model._set_schema_version(SCHEMA_VERSION)
+        Session.commit()
+
+    def test_startup_does_not_migrate(self):
+        harvest_model._set_schema_version(SCHEMA_VERSION - 1)
+        Session.commit()
+
+        harvest_model_setup()
+
+        assert get_schema_version() == SCHEMA_VERSION - 1
+
+    def test_outdated_schema_is_reported(self):
+        check_schema_version()
+
+        harvest_model._set_schema_version(SCHEMA_VERSION - 1)
+        Session.commit()
+
+        try:
+            check_schema_version()
+            assert False, 'HarvestError not raised'
+        except HarvestError, e:
+            assert 'initdb' in str(e)
+
+    def test_applied_migrations_are_skipped(self):
+        # Applying any migration again would fail on the existing columns
+        migrate()
+
+        assert get_schema_version() == SCHEMA_VERSION
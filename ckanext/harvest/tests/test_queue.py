@@ -0,0 +1,289 @@
+import datetime
+
+from ckan import model
+from ckan.model import Session, Package
+
+from ckanext.harvest import queue
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, \
+                                  HarvestObjectError, unit_of_work, \
+                                  setup as harvest_model_setup
+
+
+class _Publisher(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message_data):
+        self.sent.append(message_data['harvest_object_id'])
+
+    def close(self):
+        pass
+
+
+class _Message(object):
+
+    def __init__(self):
+        self.acked = False
+        self.requeued = False
+
+    def ack(self):
+        self.acked = True
+
+    def requeue(self):
+        self.requeued = True
+
+
+class _Harvester(object):
+    '''
+    Harvester that creates an object with guid 'new' when gathering, and
+    fails to import the objects with guid 'bad'
+    '''
+    supports_gather_checkpoints = False
+
+    def __init__(self):
+        self.gathered = []
+        self.discarded = []
+        self.flushed = 0
+        self.gather_error = None
+
+    def info(self):
+        return {'name': 'test', 'title': 'Test', 'description': 'Test harvester'}
+
+    def gather_stage(self, harvest_job):
+        self.gathered.append(harvest_job.id)
+        if self.gather_error:
+            raise self.gather_error
+        existing = [obj.id for obj in harvest_job.objects]
+        obj = HarvestObject(guid=u'new', job=harvest_job)
+        obj.save()
+        return existing + [obj.id]
+
+    def fetch_stage(self, harvest_object):
+        harvest_object.content = u'fetched'
+        harvest_object.save()
+        return True
+
+    def import_stage(self, harvest_object):
+        if harvest_object.guid == u'bad':
+            raise Exception('Import error')
+        harvest_object.current = True
+        harvest_object.save()
+
+    def flush_batch(self):
+        self.flushed += 1
+
+    def discard_object(self, harvest_object):
+        self.discarded.append(harvest_object.guid)
+
+
+class _QueueTest(object):
+
+    @classmethod
+    def setup_class(cls):
+        harvest_model_setup()
+
+    def setup(self):
+        self.harvester = _Harvester()
+        self.publisher = _Publisher()
+        self._plugin_implementations = queue.PluginImplementations
+        self._get_fetch_publisher = queue.get_fetch_publisher
+        queue.PluginImplementations = lambda interface: [self.harvester]
+        queue.get_fetch_publisher = lambda: self.publisher
+
+        self.source = HarvestSource(url=u'http://test-source.com', type=u'test')
+        Session.add(self.source)
+        Session.commit()
+
+    def teardown(self):
+        queue.PluginImplementations = self._plugin_implementations
+        queue.get_fetch_publisher = self._get_fetch_publisher
+        model.repo.rebuild_db()
+
+
+class TestGatherCallback(_QueueTest):
+
+    def _create_job(self, gather_started=None, gather_finished=None, guids=(),
+                    error_guids=()):
+        job = HarvestJob(source=self.source, gather_started=gather_started,
+                         gather_finished=gather_finished)
+        Session.add(job)
+        for guid in guids:
+            obj = HarvestObject(guid=guid, job=job, source=self.source)
+            Session.add(obj)
+            if guid in error_guids:
+                Session.add(HarvestObjectError(message=u'Error', object=obj, stage=u'Fetch'))
+        Session.commit()
+        job_id = job.id
+        Session.remove()
+        return job_id
+
+    def _gather(self, job_id):
+        message = _Message()
+        queue.gather_callback({'harvest_job_id': job_id}, message)
+        assert message.acked
+        Session.remove()
+        return HarvestJob.get(job_id)
+
+    def _guids(self, job_id):
+        return sorted(guid for (guid,) in Session.query(HarvestObject.guid) \
+                                                 .filter(HarvestObject.harvest_job_id==job_id))
+
+    def test_new_job_is_gathered(self):
+        job_id = self._create_job()
+
+        job = self._gather(job_id)
+
+        assert self.harvester.gathered == [job_id]
+        assert job.gather_started and job.gather_finished
+        assert job.status == u'Finished'
+        assert len(self.publisher.sent) == 1
+
+    def test_harvester_is_flushed_when_the_gather_fails(self):
+        job_id = self._create_job()
+        self.harvester.gather_error = Exception('Gather error')
+
+        try:
+            self._gather(job_id)
+            assert False, 'The gather error was not raised'
+        except Exception, e:
+            assert str(e) == 'Gather error'
+
+        assert self.harvester.flushed == 1
+        assert self.publisher.sent == []
+
+    def test_interrupted_gather_is_restarted(self):
+        started = datetime.datetime(2012, 6, 1)
+        job_id = self._create_job(gather_started=started, guids=[u'old-1', u'old-2'],
+                                  error_guids=[u'old-2'])
+
+        job = self._gather(job_id)
+
+        # The objects of the interrupted gather are deleted with their errors
+        assert self._guids(job_id) == [u'new'], self._guids(job_id)
+        assert Session.query(HarvestObjectError).count() == 0
+        assert len(self.publisher.sent) == 1
+        assert job.gather_started == started
+        assert job.status == u'Finished'
+
+    def test_interrupted_gather_is_resumed(self):
+        self.harvester.supports_gather_checkpoints = True
+        job_id = self._create_job(gather_started=datetime.datetime(2012, 6, 1),
+                                  guids=[u'old-1', u'old-2'])
+
+        job = self._gather(job_id)
+
+        assert self._guids(job_id) == [u'new', u'old-1', u'old-2'], self._guids(job_id)
+        assert len(self.publisher.sent) == 3
+
+    def test_finished_gather_resends_unfetched_objects(self):
+        rev = model.repo.new_revision()
+        package = Package(name=u'imported')
+        Session.add(package)
+        model.repo.commit()
+        package_id = package.id
+
+        now = datetime.datetime.now()
+        gathered = datetime.datetime(2012, 6, 1)
+        fetched = datetime.datetime(2012, 6, 2)
+        job_id = self._create_job(gather_started=now, gather_finished=now,
+                                  guids=[u'imported', u'unchanged', u'errored',
+                                         u'pending', u'stored'],
+                                  error_guids=[u'errored'])
+        objects = dict((obj.guid, obj) for obj in Session.query(HarvestObject))
+        for obj in objects.values():
+            obj.gathered = gathered
+        objects[u'imported'].package_id = package_id
+        objects[u'imported'].fetch_started = fetched
+        # Fetched, but not modified on the remote site
+        objects[u'unchanged'].fetch_started = fetched
+        # Content stored by the gather stage
+        objects[u'stored'].fetch_started = gathered
+        Session.commit()
+        pending_ids = sorted([objects[u'pending'].id, objects[u'stored'].id])
+        Session.remove()
+
+        job = self._gather(job_id)
+
+        assert self.harvester.gathered == []
+        assert sorted(self.publisher.sent) == pending_ids, self.publisher.sent
+        assert job.status == u'Finished'
+
+    def test_finished_job_is_not_gathered_again(self):
+        now = datetime.datetime.now()
+        job_id = self._create_job(gather_started=now, gather_finished=now, guids=[u'old'])
+        job = HarvestJob.get(job_id)
+        job.status = u'Finished'
+        job.save()
+        Session.remove()
+
+        self._gather(job_id)
+
+        assert self.harvester.gathered == []
+        assert self.publisher.sent == []
+
+
+class TestFetchBatch(_QueueTest):
+
+    def setup(self):
+        super(TestFetchBatch, self).setup()
+        job = HarvestJob(source=self.source)
+        Session.add(job)
+        objects = [HarvestObject(guid=guid, job=job, source=self.source)
+                   for guid in (u'good-1', u'bad', u'good-2')]
+        for obj in objects:
+            Session.add(obj)
+        Session.commit()
+        self.object_ids = [obj.id for obj in objects]
+        Session.remove()
+
+    def teardown(self):
+        unit_of_work.active = False
+        if 'commit' in unit_of_work.__dict__:
+            del unit_of_work.commit
+        super(TestFetchBatch, self).teardown()
+
+    def _fetch_batch(self):
+        unit_of_work.begin()
+        messages = []
+        for object_id in self.object_ids:
+            message = _Message()
+            queue.fetch_callback({'harvest_object_id': object_id}, message)
+            messages.append(message)
+        # Nothing is acknowledged until the batch is committed
+        assert not [message for message in messages if message.acked]
+        queue._end_batch()
+        Session.remove()
+        return messages
+
+    def _objects(self):
+        return dict((obj.guid, obj) for obj in Session.query(HarvestObject))
+
+    def test_failing_object_only_rolls_back_itself(self):
+        messages = self._fetch_batch()
+
+        assert [message.acked for message in messages] == [True] * 3
+        objects = self._objects()
+        for guid in (u'good-1', u'good-2'):
+            assert objects[guid].content == u'fetched'
+            assert objects[guid].current == True
+        assert objects[u'bad'].content is None
+        assert not objects[u'bad'].current
+        errors = Session.query(HarvestObjectError).all()
+        assert [error.harvest_object_id for error in errors] == [objects[u'bad'].id]
+        assert 'Import error' in errors[0].message
+        assert self.harvester.discarded == [u'bad']
+
+    def test_messages_are_requeued_if_the_commit_fails(self):
+        def commit():
+            unit_of_work.active = False
+            raise Exception('Commit failed')
+        unit_of_work.commit = commit
+
+        messages = self._fetch_batch()
+
+        assert [message.requeued for message in messages] == [True] * 3
+        assert not [message for message in messages if message.acked]
+        objects = self._objects()
+        assert not [obj for obj in objects.values() if obj.content is not None]
+        assert Session.query(HarvestObjectError).count() == 0